@@ -0,0 +1,378 @@
+#!/bin/env python3
+# Benchmarks for the getUSGS_CDA script.  These do not connect to CDA or the USGS.
+# run program by typing python3 benchmark_getUSGS_CDA.py params  -> USGS parameter resolution micro-benchmark
+#                       python3 benchmark_getUSGS_CDA.py replay  -> full pipeline against a local stand-in server
+# the replay benchmark uses synthetic USGS data unless a directory of recorded USGS IV json responses is given
+# with --usgs-responses, ie saved from https://waterservices.usgs.gov/nwis/iv/?format=json&sites=...
+
+import os
+import json
+import glob
+import time
+import resource
+import threading
+import numpy as np
+import pandas as pd
+import cwms
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import getUSGS_CDA
+
+
+def find_usgsparam_rowwise(USGS_ts):
+    """
+    row by row USGS parameter resolution that find_usgsparams replaced, kept as the benchmark baseline
+    """
+    USGS_Params = getUSGS_CDA.get_USGS_params()
+
+    def find_usgsparam(attribute, param):
+        if attribute > 0:
+            usgs_param = str(attribute).split(".")[0]
+        elif param in USGS_Params.index:
+            usgs_param = USGS_Params.at[param, "USGS_PARAMETER"]
+        else:
+            usgs_param = "Not Found"
+        return usgs_param
+
+    usgs_params = USGS_ts.apply(
+        lambda x: find_usgsparam(x.attribute, x.param), axis=1
+    ).astype("string")
+    return usgs_params.str.rjust(5, "0")
+
+
+def synthetic_ts_group(rows, seed=0):
+    """
+    build a synthetic time series group with a mix of default parameters, unknown parameters and attribute overrides
+    """
+    rng = np.random.default_rng(seed)
+    params = list(getUSGS_CDA.get_USGS_params().index) + ["Opening", "Volt"]
+    attribute = rng.choice([np.nan, np.nan, np.nan, 60.0, 65.0, 45.0, 62614.0], rows)
+    return pd.DataFrame({"param": rng.choice(params, rows), "attribute": attribute})
+
+
+def timed(function, *args, repeat=3):
+    """
+    best wall time in seconds of repeat calls to function and the result of the last call
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_find_usgsparams(rows):
+    USGS_ts = synthetic_ts_group(rows)
+    rowwise_time, rowwise = timed(find_usgsparam_rowwise, USGS_ts)
+    vector_time, vector = timed(
+        getUSGS_CDA.find_usgsparams, USGS_ts.attribute, USGS_ts.param
+    )
+    if not rowwise.reset_index(drop=True).equals(vector.reset_index(drop=True)):
+        raise Exception("find_usgsparams does not match the row by row resolution")
+    print(f"USGS parameter resolution for {rows} time series")
+    print(f"  row by row apply : {rowwise_time:.4f} s")
+    print(f"  vectorized       : {vector_time:.4f} s")
+    print(f"  speedup          : {rowwise_time / vector_time:.1f}x")
+
+
+def synthetic_usgs_time_series(sites, points, parameters=("00060", "00065", "00010")):
+    """
+    build USGS IV json timeSeries entries for sites x parameters with points 15 minute values each
+    """
+    start = datetime(2024, 1, 1)
+    times = [
+        (start + timedelta(minutes=15 * i)).strftime("%Y-%m-%dT%H:%M:%S.000-06:00")
+        for i in range(points)
+    ]
+    rng = np.random.default_rng(0)
+    time_series = []
+    for i in range(sites):
+        site = f"{5000000 + i:08d}"
+        for parameter in parameters:
+            values = rng.normal(100, 10, points).round(2)
+            time_series.append(
+                {
+                    "sourceInfo": {"siteCode": [{"value": site}]},
+                    "variable": {
+                        "unit": {"unitCode": "ft3/s" if parameter == "00060" else "ft"},
+                        "noDataValue": -999999.0,
+                    },
+                    "values": [
+                        {
+                            "value": [
+                                {"value": str(v), "qualifiers": ["P"], "dateTime": t}
+                                for v, t in zip(values, times)
+                            ],
+                            "qualifier": [],
+                            "method": [{"methodDescription": "", "methodID": 1}],
+                        }
+                    ],
+                    "name": f"USGS:{site}:{parameter}:00000",
+                }
+            )
+    return time_series
+
+
+def load_usgs_time_series(directory):
+    """
+    load the timeSeries entries of recorded USGS IV json responses
+    """
+    time_series = []
+    for filename in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(filename, "r") as f:
+            time_series.extend(json.load(f)["value"]["timeSeries"])
+    return time_series
+
+
+def groups_from_time_series(time_series, office):
+    """
+    build the CDA time series group and location alias group json for the USGS time series.  CWMS parameters are
+    found from the default USGS parameters, other USGS parameters are mapped with the group attribute
+    """
+    USGS_Params = getUSGS_CDA.get_USGS_params()
+    cwms_params = {}
+    for cwms_param, usgs_param in USGS_Params.USGS_PARAMETER.items():
+        cwms_params.setdefault(usgs_param, cwms_param)
+
+    ts_group = []
+    loc_group = {}
+    for ts in time_series:
+        site, parameter = ts["name"].split(":")[1:3]
+        location = f"USGS{site}"
+        ts_entry = {"office-id": office}
+        if parameter in cwms_params:
+            cwms_param = cwms_params[parameter]
+        else:
+            cwms_param = f"Code{parameter}"
+            ts_entry["attribute"] = float(parameter)
+        ts_entry["timeseries-id"] = f"{location}.{cwms_param}.Inst.15Minutes.0.bench"
+        ts_group.append(ts_entry)
+        loc_group[location] = {
+            "office-id": office,
+            "location-id": location,
+            "alias-id": site,
+        }
+    return ts_group, list(loc_group.values())
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """
+    stand-in for CDA and the USGS IV api.  serves the groups and USGS time series of the server, accepts
+    time series posted to CDA and serves the values stored so far
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.startswith("/nwis/iv"):
+            sites = set(parse_qs(url.query)["sites"][0].split(","))
+            time_series = [
+                ts
+                for site in sites
+                for ts in self.server.usgs_time_series.get(site, [])
+            ]
+            self.send_json({"value": {"timeSeries": time_series}})
+        elif "/timeseries/group/" in url.path:
+            self.send_json({"assigned-time-series": self.server.ts_group})
+        elif "/location/group/" in url.path:
+            self.send_json({"assigned-locations": self.server.loc_group})
+        elif url.path.endswith("/timeseries"):
+            name = parse_qs(url.query)["name"][0]
+            with self.server.lock:
+                values = sorted(self.server.stored_values.get(name, {}).items())
+            self.send_json(
+                {
+                    "name": name,
+                    "value-columns": [
+                        {"name": "date-time"},
+                        {"name": "value"},
+                        {"name": "quality-code"},
+                    ],
+                    "values": [[t, v, 0] for t, v in values],
+                }
+            )
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.server.cda_latency)
+        times = pd.to_datetime([value[0] for value in data["values"]], utc=True)
+        with self.server.lock:
+            self.server.series_stored += 1
+            self.server.points_stored += len(data.get("values", []))
+            stored = self.server.stored_values.setdefault(data["name"], {})
+            for t, value in zip(times, data["values"]):
+                stored[t.value // 1000000] = float(value[1])
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def start_replay_server(time_series, office, cda_latency):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ReplayHandler)
+    server.daemon_threads = True
+    server.usgs_time_series = {}
+    for ts in time_series:
+        site = ts["name"].split(":")[1]
+        server.usgs_time_series.setdefault(site, []).append(ts)
+    server.ts_group, server.loc_group = groups_from_time_series(time_series, office)
+    server.cda_latency = cda_latency
+    server.lock = threading.Lock()
+    server.series_stored = 0
+    server.points_stored = 0
+    server.stored_values = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_replay(
+    time_series,
+    office="SWT",
+    cda_latency=0.02,
+    store_workers=8,
+    store_host_limit=8,
+    fetch_chunk_size=100,
+    fetch_workers=4,
+    stream=False,
+    diff=False,
+):
+    server = start_replay_server(time_series, office, cda_latency)
+    root = f"http://127.0.0.1:{server.server_address[1]}"
+    cwms.api.init_session(api_root=f"{root}/cwms-data/", api_key="apikey benchmark")
+    getUSGS_CDA.USGS_IV_URL = f"{root}/nwis/iv/?"
+    getUSGS_CDA.run_report = getUSGS_CDA.RunReport(office)
+    timings = {}
+
+    start = time.perf_counter()
+    USGS_ts = getUSGS_CDA.get_CMWS_TS_Loc_Data(office)
+    timings["metadata"] = time.perf_counter() - start
+
+    endDT = datetime.now()
+    startDT = endDT - timedelta(days=1)
+    if stream:
+        # fetching and storing overlap so they are timed as a single stage
+        start = time.perf_counter()
+        getUSGS_CDA.CWMS_writeData_stream(
+            USGS_ts,
+            getUSGS_CDA.iter_USGS_ts(
+                USGS_ts.USGS_St_Num.unique(),
+                startDT,
+                endDT,
+                None,
+                fetch_chunk_size,
+                fetch_workers,
+            ),
+            iter([]),
+            store_workers,
+            store_host_limit,
+        )
+        timings["stream"] = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        USGS_data = getUSGS_CDA.getUSGS_ts(
+            USGS_ts.USGS_St_Num.unique(),
+            startDT,
+            endDT,
+            None,
+            fetch_chunk_size,
+            fetch_workers,
+        )
+        timings["USGS fetch"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        getUSGS_CDA.CWMS_writeData(
+            USGS_ts,
+            USGS_data,
+            pd.DataFrame(columns=getUSGS_CDA.USGS_VALUE_COLUMNS),
+            store_workers,
+            store_host_limit,
+        )
+        timings["CDA write"] = time.perf_counter() - start
+
+        if diff:
+            # everything was stored by the first write so every value should be found unchanged
+            start = time.perf_counter()
+            getUSGS_CDA.CWMS_writeData(
+                USGS_ts,
+                USGS_data,
+                pd.DataFrame(columns=getUSGS_CDA.USGS_VALUE_COLUMNS),
+                store_workers,
+                store_host_limit,
+                diff=True,
+            )
+            timings["CDA rewrite"] = time.perf_counter() - start
+    server.shutdown()
+
+    total = sum(timings.values())
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Replay of {len(time_series)} USGS time series ({len(USGS_ts)} CWMS time series)")
+    for stage, elapsed in timings.items():
+        print(f"  {stage:<11}: {elapsed:.3f} s")
+    print(f"  total      : {total:.3f} s")
+    print(f"  stored     : {server.series_stored} series, {server.points_stored} points")
+    print(f"  series/sec : {server.series_stored / total:.1f}")
+    print(f"  points/sec : {server.points_stored / total:.1f}")
+    print(f"  peak RSS   : {peak_rss:.1f} MB")
+    for line in getUSGS_CDA.run_report.summary():
+        print(f"  {line}")
+    return timings
+
+
+def main():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("benchmark", choices=["params", "replay"], help="Benchmark to run")
+    parser.add_argument("-r", "--rows", default=50000, type=int, help="params: Number of time series in the synthetic time series group")
+    parser.add_argument("-u", "--usgs-responses", default=None, type=str, help="replay: Directory of recorded USGS IV json responses. Synthetic data is used if not set")
+    parser.add_argument("-s", "--sites", default=200, type=int, help="replay: Number of synthetic USGS sites")
+    parser.add_argument("-p", "--points", default=96, type=int, help="replay: Number of values in each synthetic USGS time series")
+    parser.add_argument("-l", "--cda-latency", default=0.02, type=float, help="replay: Seconds the stand-in CDA waits before answering a store")
+    parser.add_argument("-w", "--store-workers", default=8, type=int, help="replay: Number of time series stored to CDA in parallel")
+    parser.add_argument("--store-host-limit", default=8, type=int, help="replay: Maximum number of concurrent store requests sent to the CDA host")
+    parser.add_argument("-c", "--fetch-chunk-size", default=100, type=int, help="replay: Number of USGS sites requested in a single call")
+    parser.add_argument("--fetch-workers", default=4, type=int, help="replay: Number of requests made to the USGS api in parallel")
+    parser.add_argument("--stream", action="store_true", help="replay: Stream the USGS responses with CWMS_writeData_stream")
+    parser.add_argument("--diff", action="store_true", help="replay: Write the USGS data a second time in diff mode, every value should be skipped")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the getUSGS_CDA log")
+    args = vars(parser.parse_args())
+
+    if not args["verbose"]:
+        getUSGS_CDA.logging.setLevel(getUSGS_CDA.lg.WARNING)
+
+    if args["benchmark"] == "params":
+        bench_find_usgsparams(args["rows"])
+    else:
+        if args["usgs_responses"] is not None:
+            time_series = load_usgs_time_series(args["usgs_responses"])
+        else:
+            time_series = synthetic_usgs_time_series(args["sites"], args["points"])
+        bench_replay(
+            time_series,
+            cda_latency=args["cda_latency"],
+            store_workers=args["store_workers"],
+            store_host_limit=args["store_host_limit"],
+            fetch_chunk_size=args["fetch_chunk_size"],
+            fetch_workers=args["fetch_workers"],
+            stream=args["stream"],
+            diff=args["diff"],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,26 @@
 # This getUSGS script works with CDA version 20250305.
 # and cwms-python version 0.6
 
+import os
+import json
+import codecs
+import queue
+import time
+import random
+import signal
 import logging as lg
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import cwms
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+import usgs_http
+from run_report import RunReport
+
 
 # create logging for logging
 logging = lg.getLogger()
@@ -23,17 +35,89 @@ logging.addHandler(handler)
 logging.setLevel(lg.INFO)
 logging.propagate = False
 
+# USGS instantaneous values api
+USGS_IV_URL = "https://waterservices.usgs.gov/nwis/iv/?"
+
+# columns of the long format dataframe built from the USGS api response by normalize_usgs_ts
+USGS_VALUE_COLUMNS = [
+    "Id.param",
+    "site",
+    "parameter",
+    "methodID",
+    "units",
+    "noDataValue",
+    "dateTime",
+    "value",
+    "qualifiers",
+]
+
+# semaphores that limit the number of concurrent requests sent to a single host, keyed by (host, limit) so a new
+# limit, ie after a daemon reloads its options, gets a new semaphore
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+# stage timings and counters of the current run, replaced at the start of every getusgs_cda run
+run_report = RunReport()
+
+# resolved CWMS group data of each office kept between runs in daemon mode, see get_CMWS_TS_Loc_Data_cached
+_metadata_memory = {}
 
-def getusgs_cda(api_root, office_id, days_back, api_key):
-    api_key = "apikey " + api_key
-    cwms.api.init_session(api_root=api_root, api_key=api_key)
-    logging.info(f"CDA connection: {api_root}")
+
+def getusgs_cda(
+    api_root,
+    office_id,
+    days_back,
+    api_key,
+    store_workers=8,
+    store_host_limit=8,
+    fetch_chunk_size=100,
+    fetch_workers=4,
+    state_file=None,
+    metadata_cache=None,
+    metadata_ttl=24,
+    refresh_metadata=False,
+    stream=False,
+    usgs_retries=3,
+    usgs_timeout=300,
+    report_file=None,
+    prometheus_file=None,
+    diff=False,
+    diff_tolerance=1e-6,
+    watermarks=None,
+    connect=True,
+    keep_metadata=False,
+):
+    # office_id can be a list of offices, their time series are all processed in a single pass
+    office_ids = [office_id] if isinstance(office_id, str) else list(office_id)
+    global run_report
+    run_report = RunReport(",".join(office_ids))
+    # connect is False when a daemon reuses the CDA session and USGS client of its previous run
+    if connect:
+        api_key = "apikey " + api_key
+        cwms.api.init_session(api_root=api_root, api_key=api_key)
+        logging.info(f"CDA connection: {api_root}")
+        usgs_http.configure(
+            pool_size=fetch_workers, retries=usgs_retries, timeout=(10, usgs_timeout)
+        )
     logging.info(f"Data will be grabbed and stored from USGS for past {days_back} days")
     execution_date = datetime.now()
 
-    USGS_ts = get_CMWS_TS_Loc_Data(office_id)
+    # in watermark mode only data newer than the last stored time of each time series is requested and stored.
+    # a daemon passes the watermarks of its previous run
+    if watermarks is None and state_file is not None:
+        watermarks = load_watermarks(state_file, office_ids)
+        logging.info(
+            f"Watermark mode: loaded last stored times for {len(watermarks)} time series from {state_file}"
+        )
+
+    with run_report.timed("metadata"):
+        USGS_ts = get_CMWS_TS_Loc_Data_offices(
+            office_ids, metadata_cache, metadata_ttl, refresh_metadata, keep_metadata
+        )
+    run_report.record("metadata", items=len(USGS_ts.index))
 
-    # grab all of the unique USGS stations numbers to be sent to USGS api
+    # grab all of the unique USGS stations numbers to be sent to USGS api, a site used by multiple offices is
+    # only requested once and its data is stored to the time series of every office
     sites = USGS_ts[USGS_ts["USGS_Method_TS"].isna()].USGS_St_Num.unique()
     method_sites = USGS_ts[USGS_ts["USGS_Method_TS"].notna()].USGS_St_Num.unique()
     logging.info(f"Execution date {execution_date}")
@@ -50,17 +134,180 @@ def getusgs_cda(api_root, office_id, days_back, api_key):
 
     logging.info(f"Grabing data from USGS between {startDT} and {endDT}")
 
-    USGS_data = pd.DataFrame()
-    USGS_data_method = pd.DataFrame()
+    if stream:
+        # the USGS time series are stored while the USGS responses are still being read
+        USGS_stream = iter([])
+        USGS_stream_method = iter([])
+        if len(sites) > 0:
+            USGS_stream = iter_USGS_ts_windows(
+                USGS_ts[USGS_ts["USGS_Method_TS"].isna()],
+                startDT,
+                endDT,
+                None,
+                watermarks,
+                fetch_chunk_size,
+                fetch_workers,
+            )
+        if len(method_sites) > 0:
+            USGS_stream_method = iter_USGS_ts_windows(
+                USGS_ts[USGS_ts["USGS_Method_TS"].notna()],
+                startDT,
+                endDT,
+                3,
+                watermarks,
+                fetch_chunk_size,
+                fetch_workers,
+            )
+        CWMS_writeData_stream(
+            USGS_ts,
+            USGS_stream,
+            USGS_stream_method,
+            store_workers,
+            store_host_limit,
+            watermarks,
+            diff,
+            diff_tolerance,
+        )
+    else:
+        USGS_data = pd.DataFrame(columns=USGS_VALUE_COLUMNS)
+        USGS_data_method = pd.DataFrame(columns=USGS_VALUE_COLUMNS)
 
-    if len(sites) > 0:
-        USGS_data = getUSGS_ts(sites, startDT, endDT)
-    # sites with a method_id or usgs tsid are retrieved from a seperate database. this is access using 3 as access in
-    # usgs API call.
-    if len(method_sites) > 0:
-        USGS_data_method = getUSGS_ts(method_sites, startDT, endDT, 3)
+        if len(sites) > 0:
+            USGS_data = getUSGS_ts_windows(
+                USGS_ts[USGS_ts["USGS_Method_TS"].isna()],
+                startDT,
+                endDT,
+                None,
+                watermarks,
+                fetch_chunk_size,
+                fetch_workers,
+            )
+        # sites with a method_id or usgs tsid are retrieved from a seperate database. this is access using 3 as access in
+        # usgs API call.
+        if len(method_sites) > 0:
+            USGS_data_method = getUSGS_ts_windows(
+                USGS_ts[USGS_ts["USGS_Method_TS"].notna()],
+                startDT,
+                endDT,
+                3,
+                watermarks,
+                fetch_chunk_size,
+                fetch_workers,
+            )
 
-    CWMS_writeData(USGS_ts, USGS_data, USGS_data_method)
+        CWMS_writeData(
+            USGS_ts,
+            USGS_data,
+            USGS_data_method,
+            store_workers,
+            store_host_limit,
+            watermarks,
+            diff,
+            diff_tolerance,
+        )
+
+    if state_file is not None:
+        save_watermarks(state_file, watermarks)
+        logging.info(f"Last stored times saved to {state_file}")
+    write_run_report(report_file, prometheus_file)
+
+
+def write_run_report(report_file=None, prometheus_file=None):
+    """
+    log the timings and counters of each stage of the run and save them to the json report file and
+    Prometheus textfile collector file if they are given
+    """
+    client = usgs_http.get_client()
+    client.log_metrics()
+    for line in run_report.summary():
+        logging.info(f"Stage {line}")
+    if report_file is not None:
+        run_report.write_json(report_file, client.metrics())
+        logging.info(f"Run report saved to {report_file}")
+    if prometheus_file is not None:
+        run_report.write_prometheus(prometheus_file)
+        logging.info(f"Prometheus metrics saved to {prometheus_file}")
+
+
+def load_watermarks(state_file, office_ids):
+    """
+    load the last stored time of each time series from the json state file.  returns a dictionary
+    of (office-id, ts_id) -> UTC timestamp, empty if the state file does not exist yet.  The state file holds
+    office-id -> ts_id -> time.  A state file saved before the times were kept per office holds ts_id -> time,
+    its times are used for the ts_id of each of office_ids and it is saved per office at the end of the run.
+    """
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file, "r") as f:
+        state = json.load(f)
+    watermarks = {}
+    migrated = 0
+    for key, value in state.items():
+        if isinstance(value, dict):
+            for ts_id, time in value.items():
+                watermarks[(key, ts_id)] = pd.Timestamp(time)
+        else:
+            migrated += 1
+            for office_id in office_ids:
+                watermarks[(office_id, key)] = pd.Timestamp(value)
+    if migrated > 0:
+        logging.info(
+            f"{migrated} last stored times in {state_file} are not kept per office, they are used for the time series of offices {list(office_ids)}"
+        )
+    return watermarks
+
+
+def save_watermarks(state_file, watermarks):
+    """
+    save the last stored time of each time series to the json state file as office-id -> ts_id -> time
+    """
+    state = {}
+    for (office_id, ts_id), time in sorted(watermarks.items()):
+        state.setdefault(office_id, {})[ts_id] = time.isoformat()
+    # write to a temporary file first so an interrupted run does not leave a corrupt state file
+    temp_file = f"{state_file}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(temp_file, state_file)
+
+
+def get_fetch_windows(USGS_ts, startDT, endDT, watermarks):
+    """
+    split the USGS sites into the time windows they are requested for.  returns a list of
+    [sites, startDT, modified_since].  In watermark mode sites where every time series has a last stored
+    time are requested from the oldest of those times and only if USGS modified the data since then.
+    """
+    sites = USGS_ts.USGS_St_Num.unique()
+    if not watermarks:
+        return [[sites, startDT, None]]
+
+    # the same ts_id can be used by more than one office, each has its own last stored time
+    ts_watermarks = pd.Series(
+        [
+            watermarks.get(key)
+            for key in zip(USGS_ts["office-id"], USGS_ts["timeseries-id"])
+        ],
+        index=USGS_ts.index,
+    )
+    new_site = ts_watermarks.isna().groupby(USGS_ts.USGS_St_Num.values).any()
+    new_sites = new_site[new_site].index.tolist()
+    incremental_sites = new_site[~new_site].index.tolist()
+
+    windows = []
+    if len(new_sites) > 0:
+        windows.append([new_sites, startDT, None])
+    if len(incremental_sites) > 0:
+        oldest = ts_watermarks[USGS_ts.USGS_St_Num.isin(incremental_sites).values].min()
+        # startDT and endDT are local times
+        oldest = oldest.to_pydatetime().astimezone().replace(tzinfo=None)
+        incremental_startDT = max(startDT, oldest)
+        windows.append(
+            [incremental_sites, incremental_startDT, endDT - incremental_startDT]
+        )
+        logging.info(
+            f"{len(incremental_sites)} USGS sites will only be requested from {incremental_startDT}"
+        )
+    return windows
 
 
 def get_USGS_params():
@@ -96,21 +343,126 @@ def get_USGS_params():
     return USGS_Params
 
 
-def get_CMWS_TS_Loc_Data(office):
+def find_usgsparams(attribute, param):
+    """
+    find the 5 digit USGS parameter code for each time series.  A positive attribute in the time series group
+    overrides the default USGS parameter of the CWMS parameter, "Not Found" is returned if neither is defined
+    """
+    USGS_Params = get_USGS_params()
+    attribute = pd.to_numeric(attribute, errors="coerce")
+    # the integer part of the attribute, ie 60.0 -> "60"
+    attribute_params = (
+        np.trunc(attribute.where(attribute > 0)).astype("Int64").astype("string")
+    )
+    default_params = (
+        param.map(USGS_Params.USGS_PARAMETER).fillna("Not Found").astype("string")
+    )
+    usgs_params = attribute_params.where(
+        attribute_params.notna(), default_params.values
+    )
+    return usgs_params.str.rjust(5, "0")
+
+
+def get_CMWS_TS_Loc_Data(office, location_group=None):
     """
-    get time series group and location alias information and combine into singe dataframe
+    get time series group and location alias information and combine into singe dataframe.  location_group is passed
+    to get_CMWS_groups
 
     """
+    df, Locdf = get_CMWS_groups(office, location_group)
+    return resolve_CMWS_TS_Loc_Data(office, df, Locdf)
 
-    def find_usgsparam(attribute, param):
-        if attribute > 0:
-            usgs_param = str(attribute).split(".")[0]
-        elif param in USGS_Params.index:
-            usgs_param = USGS_Params.at[param, "USGS_PARAMETER"]
+
+def get_CMWS_TS_Loc_Data_offices(
+    office_ids,
+    metadata_cache=None,
+    metadata_ttl=24,
+    refresh_metadata=False,
+    keep_metadata=False,
+):
+    """
+    get the combined time series group and location alias dataframe of every office in office_ids as a single
+    dataframe.  The office-id column tells which office each time series is stored to
+    """
+    frames = []
+    # the location group is owned by the CWMS office, it is read once and used for every office
+    location_group = {}
+    for office in office_ids:
+        if metadata_cache is not None or keep_metadata:
+            frames.append(
+                get_CMWS_TS_Loc_Data_cached(
+                    office,
+                    metadata_cache,
+                    metadata_ttl,
+                    refresh_metadata,
+                    keep_metadata,
+                    location_group,
+                )
+            )
         else:
-            usgs_param = "Not Found"
-        return usgs_param
+            frames.append(get_CMWS_TS_Loc_Data(office, location_group))
+    USGS_ts = pd.concat(frames, axis=0, ignore_index=True)
+    if len(office_ids) > 1:
+        office_count = USGS_ts.groupby("USGS_St_Num")["office-id"].nunique()
+        logging.info(
+            f"{len(office_count)} USGS sites are used by {len(office_ids)} offices, {(office_count > 1).sum()} of them by more than one office"
+        )
+    return USGS_ts
+
+
+def get_CMWS_TS_Loc_Data_cached(
+    office,
+    cache_dir,
+    ttl_hours=24,
+    refresh=False,
+    keep_in_memory=False,
+    location_group=None,
+):
+    """
+    get the combined time series group and location alias dataframe using an on disk cache.  The cached dataframe
+    is used without contacting CDA until it is older than ttl_hours, it is then rebuilt from the groups in CDA.  CDA
+    does not tell when a group last changed so the groups are not checked before the ttl.  refresh forces the cache to
+    be rebuilt.
+    keep_in_memory also keeps the cache in memory for the next call, cache_dir can then be None to not use a file.
+    location_group is passed to get_CMWS_groups
+    """
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"usgs_ts_metadata_{office}.pkl")
+    cache = None
+    if keep_in_memory and not refresh:
+        cache = _metadata_memory.get(office)
+    if cache is None and cache_file is not None and os.path.isfile(cache_file) and not refresh:
+        try:
+            cache = pd.read_pickle(cache_file)
+        except Exception as error:
+            logging.warning(f"Metadata cache {cache_file} could not be read: {error}")
+
+    if cache is not None:
+        age = datetime.now() - cache["created"]
+        if age < timedelta(hours=ttl_hours):
+            logging.info(f"CWMS TS Groups and Location Data loaded from cache for {office}")
+            if keep_in_memory:
+                _metadata_memory[office] = cache
+            return cache["USGS_ts"]
+
+    USGS_ts = get_CMWS_TS_Loc_Data(office, location_group)
+
+    cache = {"created": datetime.now(), "USGS_ts": USGS_ts}
+    if keep_in_memory:
+        _metadata_memory[office] = cache
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        pd.to_pickle(cache, cache_file)
+    return USGS_ts
+
 
+def get_CMWS_groups(office, location_group=None):
+    """
+    get the USGS time series group and the USGS Station Number location group from CDA.  location_group is a
+    dictionary shared by the offices of a run, the location group is the same for every office so it is only read
+    from CDA on the first call and kept in location_group for the others
+    """
     df = cwms.get_timeseries_group(
         group_id="USGS TS Data Acquisition",
         category_id="Data Acquisition",
@@ -119,6 +471,25 @@ def get_CMWS_TS_Loc_Data(office):
         group_office_id="CWMS",
     ).df
 
+    if location_group is None:
+        location_group = {}
+    if "Locdf" not in location_group:
+        # error in CDA with category_office_id and group_office_id. need to fix once CDA is updated
+        location_group["Locdf"] = cwms.get_location_group(
+            loc_group_id="USGS Station Number",
+            category_id="Agency Aliases",
+            office_id="CWMS",
+        ).df
+    return df, location_group["Locdf"]
+
+
+def resolve_CMWS_TS_Loc_Data(office, df, Locdf):
+    """
+    combine the time series group and location alias group into a single dataframe with the USGS station number
+    and USGS parameter of each time series
+    """
+
+    df = df.copy()
     df[["location-id", "param", "type", "int", "dur", "ver"]] = df[
         "timeseries-id"
     ].str.split(".", expand=True)
@@ -131,12 +502,7 @@ def get_CMWS_TS_Loc_Data(office):
         df["attribute"] = np.nan
     df = df.rename(columns={"alias-id": "USGS_Method_TS"})
 
-    # error in CDA with category_office_id and group_office_id. need to fix once CDA is updated
-    Locdf = cwms.get_location_group(
-        loc_group_id="USGS Station Number",
-        category_id="Agency Aliases",
-        office_id="CWMS",
-    ).df.set_index("location-id")
+    Locdf = Locdf.set_index("location-id")
 
     Locdf = Locdf[Locdf["office-id"] == office]
     if "attribute" not in Locdf.columns:
@@ -167,13 +533,9 @@ def get_CMWS_TS_Loc_Data(office):
             [USGS_ts[USGS_ts["USGS_St_Num"].notnull()], USGS_ts_base], axis=0
         )
 
-    USGS_Params = get_USGS_params()
     # this code fills in the USGS_Params field with values in the Time Series Group Attribute if it exists.  If it does not exist it
     # grabs the default USGS paramter for the coresponding CWMS parameter
-    USGS_ts.attribute = USGS_ts.apply(
-        lambda x: find_usgsparam(x.attribute, x.param), axis=1
-    ).astype("string")
-    USGS_ts.attribute = USGS_ts.attribute.str.rjust(5, "0")
+    USGS_ts.attribute = find_usgsparams(USGS_ts.attribute, USGS_ts.param)
     # renames the attribute column to USGS_PARAMETER
     USGS_ts = USGS_ts.rename(columns={"attribute": "USGS_PARAMETER"})
 
@@ -181,14 +543,111 @@ def get_CMWS_TS_Loc_Data(office):
     return USGS_ts
 
 
-def getUSGS_ts(sites, startDT, endDT, access=None):
+def getUSGS_ts_windows(
+    USGS_ts, startDT, endDT, access, watermarks, chunk_size=100, fetch_workers=4
+):
+    """
+    grab data from the USGS for the sites in USGS_ts for each of the windows from get_fetch_windows
+    """
+    USGS_frames = [
+        getUSGS_ts(
+            sites,
+            window_startDT,
+            endDT,
+            access,
+            chunk_size,
+            fetch_workers,
+            modified_since,
+        )
+        for sites, window_startDT, modified_since in get_fetch_windows(
+            USGS_ts, startDT, endDT, watermarks
+        )
+    ]
+    return concat_usgs_data(USGS_frames)
+
+
+def concat_usgs_data(USGS_frames):
     """
-    Function to grab data from the USGS based off of dataretieve-python
+    merge long format USGS dataframes
+    """
+    USGS_frames = [df for df in USGS_frames if not df.empty]
+    if len(USGS_frames) == 0:
+        return pd.DataFrame(columns=USGS_VALUE_COLUMNS)
+    USGS_data = pd.concat(USGS_frames, axis=0, ignore_index=True)
+    # the identifying columns repeat for every value so store them as categories
+    USGS_data = USGS_data.astype(
+        {"Id.param": "category", "site": "category", "parameter": "category", "units": "category"}
+    )
+    return USGS_data
+
+
+def getUSGS_ts(
+    sites,
+    startDT,
+    endDT,
+    access=None,
+    chunk_size=100,
+    fetch_workers=4,
+    modified_since=None,
+):
+    """
+    Function to grab data from the USGS based off of dataretieve-python.  The sites are split into chunks of
+    chunk_size sites that are requested in parallel and merged into a single long format dataframe
+    (see normalize_usgs_ts)
+    """
+
+    sites = list(sites)
+    chunk_size = max(1, chunk_size)
+    chunks = [sites[i : i + chunk_size] for i in range(0, len(sites), chunk_size)]
+    client = usgs_http.get_client()
+
+    def fetch(chunk):
+        try:
+            return getUSGS_ts_chunk(
+                client, chunk, startDT, endDT, access, modified_since
+            )
+        except Exception as error:
+            run_report.record("fetch", errors=1)
+            logging.error(
+                f"FAIL Error collecting data from USGS for sites {chunk[0]} to {chunk[-1]} USGS error = {error}"
+            )
+            return pd.DataFrame(columns=USGS_VALUE_COLUMNS)
+
+    with ThreadPoolExecutor(max_workers=max(1, fetch_workers)) as executor:
+        USGS_data = concat_usgs_data(executor.map(fetch, chunks))
+
+    if USGS_data.empty:
+        logging.warning("No data obtained from USGS")
+        return USGS_data
+
+    logging.info(f"Data obtained from USGS in {len(chunks)} requests")
+    return USGS_data
+
+
+def getUSGS_ts_chunk(client, sites, startDT, endDT, access=None, modified_since=None):
+    """
+    grab data from the USGS for a single chunk of sites
     """
 
     # Get USGS data
-    base_url = "https://waterservices.usgs.gov/nwis/iv/?"
+    base_url = USGS_IV_URL
+    query_dict = usgs_query(sites, startDT, endDT, access, modified_since)
 
+    with run_report.timed("fetch"):
+        response = client.get(base_url, params=query_dict)
+        response.raise_for_status()
+        r = response.json()
+    run_report.record("fetch", items=1, bytes=client.transferred(response))
+
+    # format the responce from USGS API into dataframe
+    return normalize_usgs_ts(r["value"]["timeSeries"])
+
+
+def usgs_query(sites, startDT, endDT, access=None, modified_since=None):
+    """
+    query parameters for the USGS IV api.  if modified_since (timedelta) is given only time series
+    with data changed by the USGS within that duration are returned
+    """
     query_dict = {
         "format": "json",
         "sites": ",".join(sites),
@@ -197,160 +656,791 @@ def getUSGS_ts(sites, startDT, endDT, access=None):
         "access": access,
         # "parameterCd": ",".join(unique_param_codes),
         # 'period': 'P1D',
-        # "modifiedSince": "PT6H",
         "siteStatus": "active",
     }
+    if modified_since is not None:
+        # ISO 8601 duration rounded up to the next minute
+        query_dict["modifiedSince"] = (
+            f"PT{int(np.ceil(modified_since.total_seconds() / 60))}M"
+        )
+    return query_dict
 
-    r = requests.get(base_url, params=query_dict).json()
 
-    # format the responce from USGS API into dataframe
-    USGS_data = pd.DataFrame(r["value"]["timeSeries"])
-    USGS_data["Id.param"] = (
-        USGS_data.name.str.split(":").str[1]
-        + "."
-        + USGS_data.name.str.split(":").str[2]
-    )
-    USGS_data = USGS_data.set_index("Id.param")
+def iter_USGS_ts_windows(
+    USGS_ts, startDT, endDT, access, watermarks, chunk_size=100, fetch_workers=4
+):
+    """
+    stream data from the USGS for the sites in USGS_ts for each of the windows from get_fetch_windows
+    """
+    for sites, window_startDT, modified_since in get_fetch_windows(
+        USGS_ts, startDT, endDT, watermarks
+    ):
+        yield from iter_USGS_ts(
+            sites,
+            window_startDT,
+            endDT,
+            access,
+            chunk_size,
+            fetch_workers,
+            modified_since,
+        )
+
+
+def iter_USGS_ts(
+    sites,
+    startDT,
+    endDT,
+    access=None,
+    chunk_size=100,
+    fetch_workers=4,
+    modified_since=None,
+):
+    """
+    stream the timeSeries entries of the USGS api response.  Chunks of sites are requested in parallel like getUSGS_ts
+    but each time series is yielded as soon as it is parsed.  Parsed time series wait in a queue of fetch_workers
+    entries so memory is bounded by a few time series instead of the whole response.  The fetch stage of the run report
+    includes parsing the response and waiting for the queue.
+    """
+    sites = list(sites)
+    chunk_size = max(1, chunk_size)
+    chunks = [sites[i : i + chunk_size] for i in range(0, len(sites), chunk_size)]
+    if len(chunks) == 0:
+        return
+    client = usgs_http.get_client()
+    time_series = queue.Queue(maxsize=max(1, fetch_workers))
+    stop = threading.Event()
+    chunk_done = object()
+
+    def put(item):
+        # give up if the consumer has stopped reading
+        while not stop.is_set():
+            try:
+                time_series.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(chunk):
+        start = time.perf_counter()
+        try:
+            response = client.get(
+                USGS_IV_URL,
+                params=usgs_query(chunk, startDT, endDT, access, modified_since),
+                stream=True,
+            )
+            response.raise_for_status()
+            for ts in iter_usgs_time_series(client.iter_content(response)):
+                if not put(ts):
+                    break
+            response.close()
+            run_report.record(
+                "fetch",
+                items=1,
+                bytes=client.transferred(response),
+                start=start,
+                end=time.perf_counter(),
+            )
+        except Exception as error:
+            run_report.record("fetch", errors=1, start=start, end=time.perf_counter())
+            logging.error(
+                f"FAIL Error collecting data from USGS for sites {chunk[0]} to {chunk[-1]} USGS error = {error}"
+            )
+        finally:
+            put(chunk_done)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, fetch_workers))
+    try:
+        for chunk in chunks:
+            executor.submit(fetch, chunk)
+        remaining = len(chunks)
+        while remaining > 0:
+            ts = time_series.get()
+            if ts is chunk_done:
+                remaining -= 1
+            else:
+                yield ts
+    finally:
+        stop.set()
+        executor.shutdown()
+    logging.info(f"Data streamed from USGS in {len(chunks)} requests")
+
+
+def iter_usgs_time_series(content):
+    """
+    incrementally parse the value.timeSeries array of a streamed USGS IV json response and yield each entry as soon
+    as it has been read.  content is an iterator of the bytes of the response body, ie response.iter_content().
+    Only the current time series is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    content = iter(content)
+    buffer = ""
+    eof = False
+
+    def read():
+        nonlocal buffer, eof
+        try:
+            buffer += text_decoder.decode(next(content))
+        except StopIteration:
+            buffer += text_decoder.decode(b"", final=True)
+            eof = True
 
-    logging.info("Data obtained from USGS")
+    # find the start of the timeSeries array
+    while True:
+        start = buffer.find('"timeSeries"')
+        if start >= 0:
+            start = buffer.find("[", start)
+        if start >= 0:
+            break
+        if eof:
+            raise ValueError("timeSeries not found in USGS response")
+        read()
+    buffer = buffer[start + 1 :]
+
+    # wait for this many characters before retrying to decode an incomplete entry so large entries are not
+    # decoded over and over
+    retry_len = 0
+    while True:
+        position = 0
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        buffer = buffer[position:]
+        if buffer.startswith("]"):
+            return
+        if buffer and (len(buffer) >= retry_len or eof):
+            try:
+                ts, end = decoder.raw_decode(buffer)
+                buffer = buffer[end:]
+                retry_len = 0
+                yield ts
+                continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                retry_len = 2 * len(buffer)
+        if eof:
+            raise ValueError("USGS response ended before the end of timeSeries")
+        read()
+
+
+def normalize_usgs_ts(time_series):
+    """
+    normalize the timeSeries list returned by the USGS api into a single long format dataframe with a row for
+    each value.  a method block without any values is kept as a single row with a null dateTime and value so the
+    USGS id and parameter is still known to be present in the USGS api.  A missing methodID is set to -1
+    """
+    with run_report.timed("normalize"):
+        records = []
+        series_keys = set()
+        dropped = []
+        for ts in time_series:
+            site, parameter = ts["name"].split(":")[1:3]
+            USGS_Id_param = f"{site}.{parameter}"
+            units = ts["variable"]["unit"]["unitCode"]
+            nodata_val = ts["variable"]["noDataValue"]
+            nodata_val = None if nodata_val is None else str(int(nodata_val))
+            for block in ts["values"]:
+                method_id = block["method"][0]["methodID"] if block["method"] else -1
+                # the same site, parameter and method can be returned under more than one statistic (ie 00045), only
+                # the first is used so every (Id.param, methodID) indexed by index_usgs_data is a single series
+                if (site, parameter, method_id) in series_keys:
+                    dropped.append(f"{ts['name']} methodID {method_id}")
+                    continue
+                series_keys.add((site, parameter, method_id))
+                series = (USGS_Id_param, site, parameter, method_id, units, nodata_val)
+                if not block["value"]:
+                    records.append(series + (None, None, None))
+                records.extend(
+                    series + (value["dateTime"], value["value"], value["qualifiers"])
+                    for value in block["value"]
+                )
+        USGS_data = pd.DataFrame.from_records(records, columns=USGS_VALUE_COLUMNS)
+    if dropped:
+        logging.warning(
+            f"Multiple USGS time series returned for the same site, parameter and method, only the first of each is used. The following {len(dropped)} USGS time series are not used: {dropped}"
+        )
+    run_report.record("normalize", items=len(USGS_data.index))
     return USGS_data
 
 
-def CWMS_writeData(USGS_ts, USGS_data, USGS_data_method):
-    # lists to hold time series that fail
-    # noData -> usgs location and parameter were present in USGS api but the values were empty
-    # NotinAPI -> usgs location and parameter were not retrieved from USGS api
-    # storErr -> an error occured when saving data to CWMS database
-    noData = []
-    NotinAPI = []
-    storErr = []
-    mult_ids = []
-    total_recs = len(USGS_ts.index)
-    saved = 0
+def index_usgs_data(USGS_data):
+    """
+    precompute the lookups used by CWMS_writeData on the long format USGS dataframe.  returns
+    series -> units and list of methodIDs indexed by Id.param
+    received -> number of values received from the USGS for each (Id.param, methodID)
+    values -> the USGS values with no data values (ie -999999) removed and dateTime parsed to UTC times
+    groups -> positions in values for each (Id.param, methodID)
+    """
+    with run_report.timed("normalize"):
+        keys = ["Id.param", "methodID"]
+        received = USGS_data.groupby(keys, observed=True).value.count().to_dict()
+        # remove null values and no data values (ie -999999)
+        values = USGS_data[
+            USGS_data.value.notna() & (USGS_data.value != USGS_data.noDataValue)
+        ].reset_index(drop=True)
+        # parse all of the times at once instead of for each time series, the offsets differ over a DST change
+        values["dateTime"] = pd.to_datetime(values["dateTime"], utc=True, format="ISO8601")
+        groups = values.groupby(keys, observed=True).indices
+        series = USGS_data.groupby("Id.param", observed=True).agg(
+            units=("units", "first"), methods=("methodID", lambda x: list(x.unique()))
+        )
+    return series, received, values, groups
 
-    # loop through all rows in the USGS_ts dataframe
-    for index, row in USGS_ts.iterrows():
+
+def host_semaphore(url, limit):
+    """
+    get the semaphore used to cap the number of concurrent requests made to the host of url at limit
+    """
+    key = (urlparse(url).netloc, limit)
+    with _host_semaphores_lock:
+        if key not in _host_semaphores:
+            _host_semaphores[key] = threading.BoundedSemaphore(limit)
+        return _host_semaphores[key]
+
+
+def diff_timeseries_values(times, values, existing, tolerance=1e-6):
+    """
+    compare values at times (UTC) with the existing CWMS values (the df of cwms.get_timeseries).  returns a boolean
+    array that is True for the new and changed values, and the counts of new, changed and unchanged values.  Values
+    within tolerance (relative or absolute) of the CWMS value are unchanged, CWMS converts units when storing so values
+    do not round trip exactly.
+    """
+    new_values = pd.to_numeric(pd.Series(values, dtype="object"), errors="coerce").to_numpy(
+        dtype=float
+    )
+    if existing.empty or "value" not in existing.columns:
+        old_values = np.full(len(new_values), np.nan)
+    else:
+        old = pd.to_numeric(existing["value"], errors="coerce")
+        old.index = pd.DatetimeIndex(existing["date-time"])
+        old = old[~old.index.duplicated(keep="last")]
+        old_values = old.reindex(times).to_numpy(dtype=float)
+    is_new = np.isnan(old_values)
+    unchanged = ~is_new & np.isclose(new_values, old_values, rtol=tolerance, atol=tolerance)
+    changed = ~is_new & ~unchanged
+    counts = {
+        "new": int(is_new.sum()),
+        "changed": int(changed.sum()),
+        "unchanged": int(unchanged.sum()),
+    }
+    return ~unchanged, counts
+
+
+class StoreQueue:
+    """
+    stores time series converted with cwms.timeseries_df_to_json to CWMS using a pool of worker threads that share the
+    kept alive connection of the cwms-python session.  CDA stores one time series per request so every time series is
+    its own store job.  At most two time series per worker are queued or being stored, add blocks while the store
+    workers are saturated so converted time series do not pile up in memory.  In diff mode the worker first reads the
+    values already in CWMS for the time range of the time series and only stores the new and changed values.
+    """
+
+    def __init__(
+        self,
+        store_workers=8,
+        store_host_limit=8,
+        diff=False,
+        diff_tolerance=1e-6,
+    ):
+        self.diff = diff
+        self.diff_tolerance = diff_tolerance
+        self.semaphore = host_semaphore(cwms.api.SESSION.base_url, store_host_limit)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, store_workers))
+        self.in_flight = threading.BoundedSemaphore(2 * max(1, store_workers))
+        self.futures = []
+
+    def add(self, ts_id, USGS_Id_param, data):
+        """
+        queue a time series to be stored, waiting for a store worker if all of them are busy.  returns the size of
+        the json of the time series
+        """
+        size = len(json.dumps(data))
+        self.in_flight.acquire()
+        try:
+            self.futures.append(
+                self.executor.submit(self.store, ts_id, USGS_Id_param, data, size)
+            )
+        except Exception:
+            self.in_flight.release()
+            raise
+        return size
+
+    def store(self, ts_id, USGS_Id_param, data, size):
+        try:
+            return self.store_values(ts_id, USGS_Id_param, data, size)
+        finally:
+            self.in_flight.release()
+
+    def store_values(self, ts_id, USGS_Id_param, data, size):
+        office_id = data["office-id"]
+        counts = None
+        if self.diff:
+            data, counts = self.diff_data(ts_id, data)
+            if len(data["values"]) == 0:
+                return [office_id, ts_id, USGS_Id_param, None, counts]
+        try:
+            with self.semaphore, run_report.timed("store"):
+                cwms.store_timeseries(data)
+            run_report.record("store", items=1, bytes=size)
+            return [office_id, ts_id, USGS_Id_param, None, counts]
+        except Exception as error:
+            run_report.record("store", errors=1)
+            return [office_id, ts_id, USGS_Id_param, error, counts]
+
+    def diff_data(self, ts_id, data):
+        """
+        remove the values of data that are already stored in CWMS.  returns the data to store and the counts of
+        new, changed and unchanged values, or None for the counts if the CWMS values could not be read in which case
+        all of the values are stored
+        """
+        try:
+            with self.semaphore, run_report.timed("diff"):
+                times = pd.to_datetime([value[0] for value in data["values"]], utc=True)
+                existing = cwms.get_timeseries(
+                    ts_id=ts_id,
+                    office_id=data["office-id"],
+                    unit=data["units"],
+                    begin=times.min().to_pydatetime(),
+                    end=times.max().to_pydatetime(),
+                ).df
+        except Exception as error:
+            run_report.record("diff", errors=1)
+            logging.warning(
+                f"Existing CWMS values could not be read for {ts_id}, all values will be stored. CDA error = {error}"
+            )
+            return data, None
+        keep, counts = diff_timeseries_values(
+            times, [value[1] for value in data["values"]], existing, self.diff_tolerance
+        )
+        run_report.record("diff", items=len(keep))
+        data = dict(data, values=[value for value, k in zip(data["values"], keep) if k])
+        return data, counts
+
+    def results(self):
+        """
+        yield [office-id, ts_id, USGS_Id_param, error, counts] for every queued time series as it is stored.  error
+        is None if the time series was stored successfully, counts are the new, changed and unchanged value counts in
+        diff mode
+        """
+        try:
+            for future in as_completed(self.futures):
+                yield future.result()
+        finally:
+            self.executor.shutdown()
+
+
+class CWMSWriter:
+    """
+    converts the USGS values of each CWMS time series and queues them to be stored by a StoreQueue.  Keeps the lists
+    of time series that failed, which are logged by finish
+    """
+
+    def __init__(
+        self,
+        total_recs,
+        store_workers=8,
+        store_host_limit=8,
+        watermarks=None,
+        diff=False,
+        diff_tolerance=1e-6,
+    ):
+        # lists to hold time series that fail
+        # noData -> usgs location and parameter were present in USGS api but the values were empty
+        # NotinAPI -> usgs location and parameter were not retrieved from USGS api
+        # storErr -> an error occured when saving data to CWMS database
+        # upToDate -> watermark mode only, no values newer than the last stored time were obtained from USGS
+        self.noData = []
+        self.upToDate = []
+        self.NotinAPI = []
+        self.storErr = []
+        self.mult_ids = []
+        # unchanged -> diff mode only, all of the values were already stored in CWMS
+        self.unchanged = []
+        self.diff = diff
+        self.points = {"new": 0, "changed": 0, "unchanged": 0}
+        self.total_recs = total_recs
+        self.saved = 0
+        self.watermarks = watermarks
+        # time series are stored while the remaining rows are processed
+        self.store_queue = StoreQueue(
+            store_workers,
+            store_host_limit,
+            diff,
+            diff_tolerance,
+        )
+        # latest time in the values queued for each (office-id, ts_id), used to update the watermarks
+        self.latest = {}
+
+    def write_row(self, row, USGS_index):
+        """
+        queue the values for the time series in row, USGS_index is the output of index_usgs_data for the USGS data
+        holding the USGS id and parameter of the row
+        """
+        self.convert_row(row, USGS_index)
+
+    def convert_row(self, row, USGS_index):
         # grab the CWMS time series if and the USGS station numbuer plus USGS parameter code
         ts_id = row["timeseries-id"]
         USGS_Id_param = f"{row.USGS_St_Num}.{row.USGS_PARAMETER}"
-        # check if the USGS st number and para code are in the data obtain from USGS api
         logging.info(
             f"Attempting to write values for ts_id -->  {ts_id},{USGS_Id_param}"
         )
-        values = pd.DataFrame()
-        USGS_data_row = None
-        if (USGS_Id_param in USGS_data.index) and pd.isna(row.USGS_Method_TS):
-            USGS_data_row = USGS_data.loc[USGS_Id_param]
-        elif (USGS_Id_param in USGS_data_method.index):
-            USGS_data_row = USGS_data_method.loc[USGS_Id_param]
-        if USGS_data_row is not None:
-            try:
-
-            # grab the time series values obtained from USGS API.
-                values_df = pd.DataFrame(USGS_data_row["values"])
-                if values_df.shape[0] > 1:
-                    if pd.isna(row.USGS_Method_TS):
-                        logging.warning(
-                            f"FAIL there are multiple time series for {USGS_Id_param} need to specify the USGS method TSID for {ts_id}"
-                        )
-                        mult_ids.append([ts_id, USGS_Id_param])
-                    else:
-                        temp = values_df.method.apply(pd.Series)
-                        temp = values_df.join(pd.json_normalize(temp.pop(0)))
-                        try:
-                            values = pd.DataFrame(
-                                temp.query(f"methodID == {row.USGS_Method_TS}")[
-                                    "value"
-                                ].item()
-                            )
-                        except Exception as error:
-                            mult_ids.append([ts_id, USGS_Id_param])
-                            logging.error(
-                                f"The USGS method ID defined could not be found from the USGS API check that it is correct for -->  {ts_id},{USGS_Id_param},{row.USGS_Method_TS}"
-                            )
-                else:
-                    values = pd.DataFrame(values_df.loc[0, "value"])
-                # if values array is empty then append infor to noData list
-                if values.empty:
-                    noData.append([ts_id, USGS_Id_param])
+        try:
+            series, received, USGS_values_all, groups = USGS_index
+            methods = series.at[USGS_Id_param, "methods"]
+            # grab the method block of the time series values obtained from USGS API.
+            method_id = None
+            if len(methods) > 1:
+                if pd.isna(row.USGS_Method_TS):
                     logging.warning(
-                        f"FAIL No Data obtained from USGS for ts_id: Values array is empty in USGS API output-->  {ts_id},{USGS_Id_param}"
+                        f"FAIL there are multiple time series for {USGS_Id_param} need to specify the USGS method TSID for {ts_id}"
                     )
+                    self.mult_ids.append([ts_id, USGS_Id_param])
                 else:
-                    # grab value  and for no data (ie -999999) remove from dataset
-                    nodata_val = USGS_data_row["variable"]["noDataValue"]
-                    values = values[values.value != str(int(nodata_val))]
-                    # check again if values dataframe is empty after removing nodata_vals
-                    if values.empty:
-                        noData.append([ts_id, USGS_Id_param])
-                        logging.warning(
-                            f"FAIL No Data obtained from USGS for ts_id: Values array is empty after removing -999999 values-->  {ts_id},{USGS_Id_param}"
+                    try:
+                        method_id = int(float(row.USGS_Method_TS))
+                        if method_id not in methods:
+                            raise ValueError(f"methodID {method_id} not returned")
+                    except Exception as error:
+                        method_id = None
+                        self.mult_ids.append([ts_id, USGS_Id_param])
+                        logging.error(
+                            f"The USGS method ID defined could not be found from the USGS API check that it is correct for -->  {ts_id},{USGS_Id_param},{row.USGS_Method_TS}"
                         )
-                    # if values are present grab information needed to save to CWMS database using CDA
-                    else:
-                        values = values.reindex(columns=["dateTime", "value", "qualifiers"])
-    
-                        # adjust column names to fit cwms-python format.
-                        values = values.rename(
-                            columns={
-                                "dateTime": "date-time",
-                                "qualifiers": "quality-code",
-                            }
+            elif len(methods) == 1:
+                method_id = methods[0]
+            # if values array is empty then append infor to noData list
+            if received.get((USGS_Id_param, method_id), 0) == 0:
+                self.noData.append([ts_id, USGS_Id_param])
+                logging.warning(
+                    f"FAIL No Data obtained from USGS for ts_id: Values array is empty in USGS API output-->  {ts_id},{USGS_Id_param}"
+                )
+            # check again if values are empty after removing nodata_vals
+            elif (USGS_Id_param, method_id) not in groups:
+                self.noData.append([ts_id, USGS_Id_param])
+                logging.warning(
+                    f"FAIL No Data obtained from USGS for ts_id: Values array is empty after removing -999999 values-->  {ts_id},{USGS_Id_param}"
+                )
+            # if values are present grab information needed to save to CWMS database using CDA
+            else:
+                values = USGS_values_all.iloc[groups[(USGS_Id_param, method_id)]]
+                values = values[["dateTime", "value", "qualifiers"]]
+                times = values["dateTime"]
+                # in watermark mode only keep values after the last stored time
+                key = (row["office-id"], ts_id)
+                if self.watermarks is not None and key in self.watermarks:
+                    values = values[(times > self.watermarks[key]).values]
+                    times = times[times > self.watermarks[key]]
+                self.latest[key] = times.max()
+
+                # adjust column names to fit cwms-python format.
+                values = values.rename(
+                    columns={
+                        "dateTime": "date-time",
+                        "qualifiers": "quality-code",
+                    }
+                )
+                units = series.at[USGS_Id_param, "units"]
+                office = row["office-id"]
+                values["quality-code"] = 0
+
+                if values.empty:
+                    self.upToDate.append([ts_id, USGS_Id_param])
+                    logging.info(
+                        f"No new data since the last stored time for -->  {ts_id},{USGS_Id_param}"
+                    )
+                    return
+
+                # queue values to be written to the CWMS database by the store stage
+                try:
+                    with run_report.timed("convert"):
+                        data = cwms.timeseries_df_to_json(
+                            data=values, ts_id=ts_id, units=units, office_id=office
                         )
-                        units = USGS_data_row["variable"]["unit"]["unitCode"]
-                        office = row["office-id"]
-                        values["quality-code"] = 0
-    
-                        # write values to CWMS database
-                        try:
-                            data = cwms.timeseries_df_to_json(
-                                data=values, ts_id=ts_id, units=units, office_id=office
-                            )
-                            cwms.store_timeseries(data)
-                            logging.info(
-                                f"SUCCESS Data stored in CWMS database for -->  {ts_id},{USGS_Id_param}"
-                            )
-                            saved = saved + 1
-                        except Exception as error:
-                            storErr.append([ts_id, USGS_Id_param, error])
-                            logging.error(
-                                f"FAIL Data could not be stored to CWMS database for -->  {ts_id},{USGS_Id_param} CDA error = {error}"
-                            )
-            except Exception as error:
-                logging.error(
-                                f"FAIL Unspecified Error when trying to save USGS data -->  {ts_id},{USGS_Id_param} error = {error}"
-                            )  
+                    # add waits for a store worker when all of them are busy, which is not part of the conversion
+                    with run_report.timed("store_wait"):
+                        size = self.store_queue.add(ts_id, USGS_Id_param, data)
+                    run_report.record("convert", items=1, bytes=size)
+                except Exception as error:
+                    run_report.record("convert", errors=1)
+                    self.storErr.append([ts_id, USGS_Id_param, error])
+                    logging.error(
+                        f"FAIL Data could not be stored to CWMS database for -->  {ts_id},{USGS_Id_param} CDA error = {error}"
+                    )
+        except Exception as error:
+            run_report.record("convert", errors=1)
+            logging.error(
+                f"FAIL Unspecified Error when trying to save USGS data -->  {ts_id},{USGS_Id_param} error = {error}"
+            )
+
+    def missing_row(self, row):
+        """
+        record a time series whose USGS id and parameter were not returned by the USGS api
+        """
+        ts_id = row["timeseries-id"]
+        USGS_Id_param = f"{row.USGS_St_Num}.{row.USGS_PARAMETER}"
+        logging.info(
+            f"Attempting to write values for ts_id -->  {ts_id},{USGS_Id_param}"
+        )
+        # with modifiedSince USGS does not return time series that have not changed since the last run
+        if self.watermarks is not None and (row["office-id"], ts_id) in self.watermarks:
+            self.upToDate.append([ts_id, USGS_Id_param])
+            logging.info(
+                f"No data modified by USGS since the last stored time for -->  {ts_id},{USGS_Id_param}"
+            )
         else:
-            NotinAPI.append([ts_id, USGS_Id_param])
+            self.NotinAPI.append([ts_id, USGS_Id_param])
             logging.warning(
                 f"FAIL USGS ID and parameter were not present in USGS API for-->  {ts_id},{USGS_Id_param}"
             )
 
-    logging.info(
-        f"A total of {saved} records were successfully saved out of {total_recs}"
-    )
-    logging.info(
-        f"The following ts_ids errored due to no data received from USGS for the time period requested: {noData}"
+    def finish(self):
+        """
+        wait for all of the queued time series to be stored and log the results
+        """
+        # results are collected in this thread so the saved count and storErr list do not need to be locked.
+        for office_id, ts_id, USGS_Id_param, error, counts in self.store_queue.results():
+            if counts is not None:
+                for key, count in counts.items():
+                    self.points[key] += count
+                logging.info(
+                    f"Diff with CWMS for -->  {ts_id},{USGS_Id_param}: {counts['new']} new, {counts['changed']} changed, {counts['unchanged']} unchanged values"
+                )
+            if error is None and counts is not None and counts["unchanged"] == sum(counts.values()):
+                # nothing was sent to CWMS
+                self.unchanged.append([ts_id, USGS_Id_param])
+                if self.watermarks is not None:
+                    self.watermarks[(office_id, ts_id)] = self.latest[(office_id, ts_id)]
+            elif error is None:
+                logging.info(
+                    f"SUCCESS Data stored in CWMS database for -->  {ts_id},{USGS_Id_param}"
+                )
+                self.saved = self.saved + 1
+                if self.watermarks is not None:
+                    self.watermarks[(office_id, ts_id)] = self.latest[(office_id, ts_id)]
+            else:
+                self.storErr.append([ts_id, USGS_Id_param, error])
+                logging.error(
+                    f"FAIL Data could not be stored to CWMS database for -->  {ts_id},{USGS_Id_param} CDA error = {error}"
+                )
+
+        run_report.set_counts(
+            series_total=self.total_recs,
+            series_saved=self.saved,
+            series_no_data=len(self.noData),
+            series_not_in_usgs=len(self.NotinAPI),
+            series_store_errors=len(self.storErr),
+            series_up_to_date=len(self.upToDate),
+            series_multiple_methods=len(self.mult_ids),
+        )
+        if self.diff:
+            run_report.set_counts(
+                series_unchanged=len(self.unchanged),
+                points_new=self.points["new"],
+                points_changed=self.points["changed"],
+                points_unchanged=self.points["unchanged"],
+            )
+        logging.info(
+            f"A total of {self.saved} records were successfully saved out of {self.total_recs}"
+        )
+        logging.info(
+            f"The following ts_ids errored due to no data received from USGS for the time period requested: {self.noData}"
+        )
+        logging.info(
+            f"The following ts_ids errored because the USGS ID and parameter were not found in USGS API {self.NotinAPI}"
+        )
+        logging.info(
+            f"The following ts_ids errored when storing into CDA {self.storErr}"
+        )
+        if self.watermarks is not None:
+            logging.info(
+                f"The following ts_ids had no new data since the last stored time: {self.upToDate}"
+            )
+        if self.diff:
+            logging.info(
+                f"Diff mode: {self.points['new']} new, {self.points['changed']} changed and {self.points['unchanged']} unchanged values were obtained from USGS"
+            )
+            logging.info(
+                f"The following ts_ids were not stored because all of their values are already in CWMS: {self.unchanged}"
+            )
+        logging.info(
+            f"The following ts_ids errored because multiple method TSID were present for the USGS station. A USGS method TSID needs to be defined in the time series group in CWMS or an incorrect TSID is defined. {self.mult_ids}"
+        )
+
+
+def CWMS_writeData(
+    USGS_ts,
+    USGS_data,
+    USGS_data_method,
+    store_workers=8,
+    store_host_limit=8,
+    watermarks=None,
+    diff=False,
+    diff_tolerance=1e-6,
+):
+    writer = CWMSWriter(
+        len(USGS_ts.index),
+        store_workers,
+        store_host_limit,
+        watermarks,
+        diff,
+        diff_tolerance,
     )
-    logging.info(
-        f"The following ts_ids errored because the USGS ID and parameter were not found in USGS API {NotinAPI}"
+    USGS_index = index_usgs_data(USGS_data)
+    USGS_method_index = index_usgs_data(USGS_data_method)
+
+    # loop through all rows in the USGS_ts dataframe
+    for index, row in USGS_ts.iterrows():
+        USGS_Id_param = f"{row.USGS_St_Num}.{row.USGS_PARAMETER}"
+        # check if the USGS st number and para code are in the data obtain from USGS api
+        if (USGS_Id_param in USGS_index[0].index) and pd.isna(row.USGS_Method_TS):
+            writer.write_row(row, USGS_index)
+        elif USGS_Id_param in USGS_method_index[0].index:
+            writer.write_row(row, USGS_method_index)
+        else:
+            writer.missing_row(row)
+
+    writer.finish()
+
+
+def CWMS_writeData_stream(
+    USGS_ts,
+    USGS_stream,
+    USGS_stream_method,
+    store_workers=8,
+    store_host_limit=8,
+    watermarks=None,
+    diff=False,
+    diff_tolerance=1e-6,
+):
+    """
+    same as CWMS_writeData but the USGS data are iterators of timeSeries entries (see iter_USGS_ts).  Each USGS
+    time series is converted and queued to be stored as soon as it is parsed, so only one USGS time series is held
+    in memory at a time.  USGS_stream is read before USGS_stream_method so the same data is used as CWMS_writeData.
+    """
+    writer = CWMSWriter(
+        len(USGS_ts.index),
+        store_workers,
+        store_host_limit,
+        watermarks,
+        diff,
+        diff_tolerance,
     )
-    logging.info(f"The following ts_ids errored when storing into CDA {storErr}")
+    USGS_ts = USGS_ts.reset_index(drop=True)
+    Id_params = USGS_ts.USGS_St_Num + "." + USGS_ts.USGS_PARAMETER
+    rows_by_Id_param = Id_params.groupby(Id_params.values).indices
+    written = set()
+
+    for time_series, method_stream in ((USGS_stream, False), (USGS_stream_method, True)):
+        Id_params_seen = set()
+        for ts in time_series:
+            USGS_data = normalize_usgs_ts([ts])
+            if USGS_data.empty:
+                continue
+            USGS_Id_param = USGS_data.at[0, "Id.param"]
+            if USGS_Id_param in Id_params_seen:
+                logging.warning(
+                    f"Multiple USGS time series returned for {USGS_Id_param}, {ts['name']} is not used"
+                )
+                continue
+            Id_params_seen.add(USGS_Id_param)
+            USGS_index = index_usgs_data(USGS_data)
+            for i in rows_by_Id_param.get(USGS_Id_param, []):
+                row = USGS_ts.iloc[i]
+                # time series with a method TSID only use data from the method stream
+                if i in written or not (method_stream or pd.isna(row.USGS_Method_TS)):
+                    continue
+                written.add(i)
+                writer.write_row(row, USGS_index)
+
+    for i, row in USGS_ts.iterrows():
+        if i not in written:
+            writer.missing_row(row)
+
+    writer.finish()
+
+
+def run_daemon(parser):
+    """
+    run getusgs_cda every --interval minutes plus a random jitter until SIGTERM or SIGINT.  The CDA session, USGS
+    client and CWMS group data are kept between runs.  With --state-file the last stored times are also kept between
+    runs so each run only requests new USGS data, without it every run requests --days_back days like a single run.
+    SIGHUP reloads the command line options, including options read from an @file and the api key file, refreshes the
+    CWMS group data and starts a run.
+    """
+    wake = threading.Event()
+    reload = threading.Event()
+    stop = threading.Event()
+
+    def on_reload(signum, frame):
+        reload.set()
+        wake.set()
+
+    def on_stop(signum, frame):
+        stop.set()
+        wake.set()
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, on_reload)
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+
+    args = vars(parser.parse_args())
+    options = get_run_options(args)
+    watermarks = None
+    if options["state_file"] is not None:
+        watermarks = load_watermarks(options["state_file"], options["office_id"])
+    connect = True
+    refresh = options["refresh_metadata"]
     logging.info(
-        f"The following ts_ids errored because multiple method TSID were present for the USGS station. A USGS method TSID needs to be defined in the time series group in CWMS or an incorrect TSID is defined. {mult_ids}"
+        f"Daemon mode: running every {args['interval']} minutes with up to {args['jitter']} seconds of jitter"
     )
 
-def main() -> None :
-    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
-    parser.add_argument("-d", "--days_back", default="1", help="Days back from current time to get data.  Can be decimal and integer values")
-    parser.add_argument("-o", "--office", required=True, type=str, help="Office to grab data for (Required).")
-    parser.add_argument("-a", "--api_root", required=True, type=str, help="Api Root for CDA (Required).")
-    parser.add_argument("-k", "--api_key", default=None, type=str, help="api key. one of api_key or api_key_loc are required")
-    parser.add_argument("-kl", "--api_key_loc", default=None, type=str, help="file storing Api Key. One of api_key or api_key_loc are required")
-    args = vars(parser.parse_args())
+    while not stop.is_set():
+        if reload.is_set():
+            reload.clear()
+            # the new options are only used if all of them are read, otherwise the previous args and options are kept
+            try:
+                new_args = vars(parser.parse_args())
+                new_options = get_run_options(new_args)
+            except (Exception, SystemExit) as error:
+                logging.error(f"FAIL options could not be reloaded, the previous options are kept. error = {error}")
+            else:
+                args = new_args
+                options = new_options
+                logging.info("Options reloaded")
+                watermarks = None
+                if options["state_file"] is not None:
+                    watermarks = load_watermarks(options["state_file"], options["office_id"])
+                connect = True
+                refresh = True
+
+        start = time.monotonic()
+        try:
+            getusgs_cda(
+                **dict(options, refresh_metadata=refresh),
+                watermarks=watermarks,
+                connect=connect,
+                keep_metadata=True,
+            )
+            connect = False
+            refresh = False
+        except Exception as error:
+            logging.error(f"FAIL getUSGS_CDA run failed, it will be run again at the next interval. error = {error}")
 
-    OFFICE = args["office"]
-    APIROOT = args["api_root"]
+        delay = max(0, args["interval"] * 60 - (time.monotonic() - start))
+        delay = delay + random.uniform(0, args["jitter"])
+        logging.info(f"Next run in {delay:.0f} seconds")
+        wake.wait(delay)
+        wake.clear()
+    logging.info("Daemon stopped")
+
+
+def get_run_options(args):
+    """
+    getusgs_cda keyword arguments from the parsed command line arguments
+    """
     # place a file in .cwms names api_key that holds you apikey
     # to be used to write data to the database using CDA
     if args["api_key_loc"] is not None:
@@ -367,15 +1457,61 @@ def main() -> None :
     # the 5 would mean grab data starting 5 days ago to now
     DAYS_BACK = float(args["days_back"])
 
-    # import CWMS module and assign the apiROOT and apikey to be
-    # used throughout the program
-    getusgs_cda(
-                    api_root=APIROOT,
-                    office_id=OFFICE,
-                    days_back=DAYS_BACK,
-                    api_key=APIKEY,
-                )
+    return dict(
+        api_root=args["api_root"],
+        office_id=args["office"],
+        days_back=DAYS_BACK,
+        api_key=APIKEY,
+        store_workers=args["store_workers"],
+        store_host_limit=args["store_host_limit"],
+        fetch_chunk_size=args["fetch_chunk_size"],
+        fetch_workers=args["fetch_workers"],
+        state_file=args["state_file"],
+        metadata_cache=args["metadata_cache"],
+        metadata_ttl=args["metadata_ttl"],
+        refresh_metadata=args["refresh_metadata"],
+        stream=args["stream"],
+        usgs_retries=args["usgs_retries"],
+        usgs_timeout=args["usgs_timeout"],
+        report_file=args["report_file"],
+        prometheus_file=args["prometheus_file"],
+        diff=args["diff"],
+        diff_tolerance=args["diff_tolerance"],
+    )
+
+
+def main() -> None :
+    # options can also be read from a file, one per line, by passing @filename
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter, fromfile_prefix_chars="@")
+    parser.add_argument("-d", "--days_back", default="1", help="Days back from current time to get data.  Can be decimal and integer values")
+    parser.add_argument("-o", "--office", required=True, type=str, nargs="+", help="Office to grab data for (Required). Multiple offices can be given, each USGS site is then requested once and its data stored to the time series of every office")
+    parser.add_argument("-a", "--api_root", required=True, type=str, help="Api Root for CDA (Required).")
+    parser.add_argument("-k", "--api_key", default=None, type=str, help="api key. one of api_key or api_key_loc are required")
+    parser.add_argument("-kl", "--api_key_loc", default=None, type=str, help="file storing Api Key. One of api_key or api_key_loc are required")
+    parser.add_argument("-w", "--store-workers", default=8, type=int, help="Number of time series stored to CDA in parallel")
+    parser.add_argument("--store-host-limit", default=8, type=int, help="Maximum number of concurrent store requests sent to the CDA host")
+    parser.add_argument("-c", "--fetch-chunk-size", default=100, type=int, help="Number of USGS sites requested from the USGS api in a single call")
+    parser.add_argument("--fetch-workers", default=4, type=int, help="Number of requests made to the USGS api in parallel")
+    parser.add_argument("-s", "--state-file", default=None, type=str, help="JSON file holding the last stored time of each time series. When set only data newer than the last stored time is requested and stored")
+    parser.add_argument("-m", "--metadata-cache", default=None, type=str, help="Directory to cache the CWMS time series group and location alias data in. Caching is off if not set")
+    parser.add_argument("--metadata-ttl", default=24, type=float, help="Hours the cached CWMS group data is used before it is rebuilt from CDA")
+    parser.add_argument("--refresh-metadata", action="store_true", help="Rebuild the cached CWMS group data")
+    parser.add_argument("--stream", action="store_true", help="Parse the USGS responses incrementally and store each time series as soon as it is read")
+    parser.add_argument("--usgs-retries", default=3, type=int, help="Number of times a USGS request that failed with a 429 or 5xx status is retried")
+    parser.add_argument("--usgs-timeout", default=300, type=float, help="Seconds to wait for the USGS api to send data before a request fails")
+    parser.add_argument("-r", "--report-file", default=None, type=str, help="JSON file to save the timings and counts of each stage of the run to")
+    parser.add_argument("--prometheus-file", default=None, type=str, help="File to save the run metrics to in the Prometheus text format, ie a .prom file in the node exporter textfile collector directory")
+    parser.add_argument("--diff", action="store_true", help="Read the values already stored in CWMS and only store the values that are new or changed")
+    parser.add_argument("--diff-tolerance", default=1e-6, type=float, help="Relative and absolute tolerance used to decide if a value matches the value stored in CWMS in diff mode")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and get data from USGS every --interval minutes. SIGHUP reloads the options")
+    parser.add_argument("--interval", default=15, type=float, help="Daemon mode: minutes between the start of each run")
+    parser.add_argument("--jitter", default=60, type=float, help="Daemon mode: maximum random seconds added to the wait between runs")
+    args = vars(parser.parse_args())
+
+    if args["daemon"]:
+        run_daemon(parser)
+    else:
+        getusgs_cda(**get_run_options(args))
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,142 @@
+#!/bin/env python3
+# Instrumentation of the stages of a getUSGS_CDA run (metadata load, USGS fetch, normalize, convert, diff and store).
+# store_wait is the time the conversion waits for a free store worker before it can queue a time series.
+# Each stage keeps its wall time, the time spent in it summed over all threads, and item, byte and error counts.
+# The results are written as a JSON run report and optionally as a Prometheus textfile collector file.
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+STAGES = ["metadata", "fetch", "normalize", "convert", "store_wait", "diff", "store"]
+
+
+class RunReport:
+    """
+    thread safe timings and counters of the stages of a single run.
+    wall_seconds -> time from the first start to the last end of the stage
+    busy_seconds -> time spent in the stage summed over all of the threads working on it
+    items, bytes, errors -> counts recorded by the stage
+    """
+
+    def __init__(self, office=None):
+        self.office = office
+        self.started = datetime.now(timezone.utc)
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stages = {
+            stage: {
+                "wall_seconds": 0.0,
+                "busy_seconds": 0.0,
+                "items": 0,
+                "bytes": 0,
+                "errors": 0,
+            }
+            for stage in STAGES
+        }
+        # first start and last end of each stage
+        self.spans = {}
+        # results of the run, ie the number of time series saved
+        self.counts = {}
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        time the block as part of stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start=start, end=time.perf_counter())
+
+    def record(self, stage, items=0, bytes=0, errors=0, start=None, end=None):
+        """
+        add to the counters of stage, and the time from start to end if given (time.perf_counter values)
+        """
+        with self.lock:
+            stats = self.stages[stage]
+            stats["items"] += items
+            stats["bytes"] += bytes
+            stats["errors"] += errors
+            if start is not None:
+                stats["busy_seconds"] += end - start
+                span = self.spans.setdefault(stage, [start, end])
+                span[0] = min(span[0], start)
+                span[1] = max(span[1], end)
+                stats["wall_seconds"] = span[1] - span[0]
+
+    def set_counts(self, **counts):
+        with self.lock:
+            self.counts.update(counts)
+
+    def report(self, http_metrics=None):
+        """
+        the run report as a dictionary
+        """
+        with self.lock:
+            report = {
+                "office": self.office,
+                "started": self.started.isoformat(),
+                "run_seconds": time.perf_counter() - self.start_time,
+                "stages": {stage: dict(stats) for stage, stats in self.stages.items()},
+                "counts": dict(self.counts),
+            }
+        if http_metrics is not None:
+            report["http"] = http_metrics
+        return report
+
+    def write_json(self, report_file, http_metrics=None):
+        write_atomic(report_file, json.dumps(self.report(http_metrics), indent=1))
+
+    def write_prometheus(self, prom_file, prefix="getusgs"):
+        """
+        write the report in the Prometheus text format to be picked up by the node exporter textfile collector
+        """
+        report = self.report()
+        office = f'office="{report["office"]}"' if report["office"] else ""
+        lines = []
+        for field, kind in (
+            ("wall_seconds", "gauge"),
+            ("busy_seconds", "gauge"),
+            ("items", "gauge"),
+            ("bytes", "gauge"),
+            ("errors", "gauge"),
+        ):
+            name = f"{prefix}_stage_{field}"
+            lines.append(f"# TYPE {name} {kind}")
+            for stage, stats in report["stages"].items():
+                labels = ",".join(label for label in (office, f'stage="{stage}"') if label)
+                lines.append(f"{name}{{{labels}}} {stats[field]}")
+        for count, value in report["counts"].items():
+            name = f"{prefix}_{count}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{{{office}}} {value}")
+        lines.append(f"# TYPE {prefix}_run_seconds gauge")
+        lines.append(f"{prefix}_run_seconds{{{office}}} {report['run_seconds']}")
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(
+            f"{prefix}_last_run_timestamp_seconds{{{office}}} {self.started.timestamp()}"
+        )
+        write_atomic(prom_file, "\n".join(lines) + "\n")
+
+    def summary(self):
+        """
+        one line per stage for the log
+        """
+        return [
+            f"{stage}: {stats['wall_seconds']:.2f} s wall, {stats['busy_seconds']:.2f} s busy, "
+            f"{stats['items']} items, {stats['bytes'] / 1e6:.2f} MB, {stats['errors']} errors"
+            for stage, stats in self.report()["stages"].items()
+        ]
+
+
+def write_atomic(file, text):
+    # the textfile collector can read the file at any time so it is replaced in one step
+    temp_file = f"{file}.tmp"
+    with open(temp_file, "w") as f:
+        f.write(text)
+    os.replace(temp_file, file)
@@ -0,0 +1,210 @@
+import json
+import os
+import tempfile
+import unittest
+
+import cwms
+import numpy as np
+import pandas as pd
+
+import getUSGS_CDA
+
+
+def usgs_time_series(site, times, values, statistic="00000", method_id=1):
+    """
+    an entry of the value.timeSeries array of a USGS IV response
+    """
+    return {
+        "name": f"USGS:{site}:00060:{statistic}",
+        "variable": {"unit": {"unitCode": "ft3/s"}, "noDataValue": -999999.0},
+        "values": [
+            {
+                "method": [{"methodID": method_id}],
+                "value": [
+                    {"dateTime": t, "value": v, "qualifiers": ["P"]}
+                    for t, v in zip(times, values)
+                ],
+            }
+        ],
+    }
+
+
+class NormalizeUsgsTsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.times = ["2024-01-01T00:00:00.000-06:00", "2024-01-01T00:15:00.000-06:00"]
+
+    def test_duplicate_series_dropped(self):
+        time_series = [
+            usgs_time_series("07331000", self.times, ["1", "2"]),
+            # the same site, parameter and method under another statistic
+            usgs_time_series("07331000", self.times, ["5", "6"], statistic="00003"),
+        ]
+        with self.assertLogs(getUSGS_CDA.logging, "WARNING") as logs:
+            USGS_data = getUSGS_CDA.normalize_usgs_ts(time_series)
+        self.assertIn("USGS:07331000:00060:00003 methodID 1", logs.output[0])
+        self.assertEqual(["1", "2"], USGS_data["value"].tolist())
+        series, received, values, groups = getUSGS_CDA.index_usgs_data(USGS_data)
+        self.assertEqual([1], series.at["07331000.00060", "methods"])
+        self.assertEqual(2, received[("07331000.00060", 1)])
+
+    def test_other_method_kept(self):
+        time_series = [
+            usgs_time_series("07331000", self.times, ["1", "2"]),
+            usgs_time_series("07331000", self.times, ["5", "6"], statistic="00003", method_id=2),
+        ]
+        USGS_data = getUSGS_CDA.normalize_usgs_ts(time_series)
+        series, received, values, groups = getUSGS_CDA.index_usgs_data(USGS_data)
+        self.assertEqual([1, 2], series.at["07331000.00060", "methods"])
+        self.assertEqual(["5", "6"], values.iloc[groups[("07331000.00060", 2)]]["value"].tolist())
+
+
+class DiffTimeseriesValuesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.times = pd.to_datetime(
+            ["2024-01-01T00:00Z", "2024-01-01T01:00Z", "2024-01-01T02:00Z", "2024-01-01T03:00Z"], utc=True
+        )
+        # CWMS has the first three times, the last time is new
+        self.existing = pd.DataFrame(
+            {"date-time": self.times[:3], "value": [100.0, 200.0, 300.0]}
+        )
+
+    def test_counts(self):
+        keep, counts = getUSGS_CDA.diff_timeseries_values(
+            self.times, ["100", "200.01", "305", "400"], self.existing, tolerance=1e-6
+        )
+        self.assertEqual({"new": 1, "changed": 2, "unchanged": 1}, counts)
+        self.assertEqual([False, True, True, True], list(keep))
+
+    def test_tolerance(self):
+        keep, counts = getUSGS_CDA.diff_timeseries_values(
+            self.times, ["100", "200.01", "305", "400"], self.existing, tolerance=1e-4
+        )
+        self.assertEqual({"new": 1, "changed": 1, "unchanged": 2}, counts)
+        self.assertEqual([False, False, True, True], list(keep))
+
+    def test_no_existing_values(self):
+        keep, counts = getUSGS_CDA.diff_timeseries_values(
+            self.times, ["1", "2", "3", "4"], pd.DataFrame(), tolerance=1e-6
+        )
+        self.assertEqual({"new": 4, "changed": 0, "unchanged": 0}, counts)
+        self.assertTrue(keep.all())
+
+
+class IterUsgsTimeSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time_series = [
+            usgs_time_series("07331000", ["2024-01-01T00:00:00.000-06:00"], ["10.5"]),
+            # a multi byte character so a chunk can also end inside a utf-8 sequence
+            dict(usgs_time_series("07332000", ["2024-01-01T00:00:00.000-06:00"], ["20"]), note="débit"),
+        ]
+        self.body = json.dumps(
+            {"name": "ns1:timeSeriesResponseType", "value": {"queryInfo": {}, "timeSeries": self.time_series}}
+        ).encode("utf-8")
+
+    def test_single_chunk(self):
+        self.assertEqual(self.time_series, list(getUSGS_CDA.iter_usgs_time_series([self.body])))
+
+    def test_chunk_boundary_in_object(self):
+        # split the body at every position so the boundary falls inside each of the json objects
+        for split in range(1, len(self.body)):
+            chunks = [self.body[:split], self.body[split:]]
+            self.assertEqual(self.time_series, list(getUSGS_CDA.iter_usgs_time_series(chunks)), split)
+
+    def test_small_chunks(self):
+        chunks = [self.body[i : i + 7] for i in range(0, len(self.body), 7)]
+        self.assertEqual(self.time_series, list(getUSGS_CDA.iter_usgs_time_series(chunks)))
+
+    def test_truncated_response(self):
+        end = self.body.find(b"07332000")
+        with self.assertRaises(ValueError):
+            list(getUSGS_CDA.iter_usgs_time_series([self.body[:end]]))
+
+
+class WatermarkCutoffTest(unittest.TestCase):
+
+    def setUp(self):
+        cwms.api.init_session(api_root="http://localhost:8081/cwms-data/")
+        self.ts_id = "KEYS.Flow.Inst.15Minutes.0.USGS-raw"
+        self.row = pd.Series(
+            {
+                "timeseries-id": self.ts_id,
+                "office-id": "SWT",
+                "USGS_St_Num": "07331000",
+                "USGS_PARAMETER": "00060",
+                "USGS_Method_TS": np.nan,
+            }
+        )
+        times = ["2024-01-01T00:00:00.000-06:00", "2024-01-01T00:15:00.000-06:00", "2024-01-01T00:30:00.000-06:00"]
+        USGS_data = getUSGS_CDA.normalize_usgs_ts([usgs_time_series("07331000", times, ["1", "2", "3"])])
+        self.USGS_index = getUSGS_CDA.index_usgs_data(USGS_data)
+        self.times = pd.to_datetime(times, utc=True)
+        self.queued = []
+
+    def write(self, watermarks):
+        writer = getUSGS_CDA.CWMSWriter(1, store_workers=1, watermarks=watermarks)
+        self.addCleanup(writer.store_queue.executor.shutdown)
+        writer.store_queue.add = lambda ts_id, USGS_Id_param, data: self.queued.append(data) or 0
+        writer.write_row(self.row, self.USGS_index)
+        return writer
+
+    def queued_times(self):
+        return [pd.Timestamp(value[0]) for data in self.queued for value in data["values"]]
+
+    def test_value_at_watermark_not_stored(self):
+        writer = self.write({("SWT", self.ts_id): self.times[1]})
+        self.assertEqual([self.times[2]], self.queued_times())
+        self.assertEqual(self.times[2], writer.latest[("SWT", self.ts_id)])
+
+    def test_all_values_at_or_before_watermark(self):
+        writer = self.write({("SWT", self.ts_id): self.times[2]})
+        self.assertEqual([], self.queued)
+        self.assertEqual(1, len(writer.upToDate))
+
+    def test_no_watermark(self):
+        self.write({})
+        self.assertEqual(list(self.times), self.queued_times())
+
+    def test_watermark_of_other_office(self):
+        self.write({("SWF", self.ts_id): self.times[2]})
+        self.assertEqual(list(self.times), self.queued_times())
+
+
+class WatermarkStateFileTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.state_file = os.path.join(directory.name, "state.json")
+        self.time = pd.Timestamp("2024-01-01T06:30Z")
+
+    def test_save_and_load(self):
+        watermarks = {("SWT", "KEYS.Flow"): self.time, ("SWF", "KEYS.Flow"): self.time + pd.Timedelta("1h")}
+        getUSGS_CDA.save_watermarks(self.state_file, watermarks)
+        self.assertEqual(watermarks, getUSGS_CDA.load_watermarks(self.state_file, ["SWT"]))
+
+    def test_migrate_ts_id_keys(self):
+        with open(self.state_file, "w") as f:
+            json.dump({"KEYS.Flow": self.time.isoformat()}, f)
+        self.assertEqual(
+            {("SWT", "KEYS.Flow"): self.time, ("SWF", "KEYS.Flow"): self.time},
+            getUSGS_CDA.load_watermarks(self.state_file, ["SWT", "SWF"]),
+        )
+
+
+class UsgsHttpCopyTest(unittest.TestCase):
+
+    def test_same_as_get_USGS_rating_copy(self):
+        # the USGS http client is kept in each script directory so they can be deployed on their own
+        directory = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(directory, "usgs_http.py"), "rb") as f:
+            module = f.read()
+        with open(os.path.join(directory, "..", "get_USGS_rating", "usgs_http.py"), "rb") as f:
+            other_module = f.read()
+        self.assertEqual(module, other_module, "usgs_http.py differs from src/get_USGS_rating/usgs_http.py")
+
+
+if __name__ == '__main__':
+    unittest.main()
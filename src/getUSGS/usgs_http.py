@@ -0,0 +1,156 @@
+#!/bin/env python3
+# HTTP client used by the scripts that request data from the USGS (getUSGS_CDA and getUSGS_ratings_CDA).
+# Each script directory is deployed on its own so the same module is kept in src/getUSGS and src/get_USGS_rating.
+# Change both copies together, the tests of both directories fail when the copies differ.
+# A single pooled requests session is used so connections are kept alive and reused.  Responses are requested
+# gzip/deflate compressed, failed requests (429 and 5xx) are retried with a backoff and every request has a timeout.
+# The number of requests, bytes transferred and a latency histogram are kept for each host.
+
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")]
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class UsgsHttpClient:
+    """
+    pooled requests session with retries, timeouts, compressed transfer and per host metrics
+    """
+
+    def __init__(
+        self, pool_size=10, retries=3, backoff_factor=1, timeout=(10, 300)
+    ):
+        self.timeout = timeout
+        retry_strategy = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry_strategy,
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        self.lock = threading.Lock()
+        self.host_metrics = {}
+
+    def get(self, url, params=None, stream=False, **kwargs):
+        """
+        GET url.  Unless stream is set the response body is read and counted here, for a streamed response read
+        the body with iter_content so the bytes are counted
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, params=params, stream=stream, **kwargs)
+        except Exception:
+            self.record(url, time.perf_counter() - start, 0, error=True)
+            raise
+        latency = time.perf_counter() - start
+        if stream:
+            self.record(url, latency, 0, error=not response.ok)
+        else:
+            # read the body so the bytes transferred are known
+            response.content
+            self.record(url, latency, self.transferred(response), error=not response.ok)
+        return response
+
+    def iter_content(self, response, chunk_size=65536):
+        """
+        iterate over the body of a streamed response, counting the bytes transferred once it has been read
+        """
+        try:
+            yield from response.iter_content(chunk_size=chunk_size)
+        finally:
+            self.record(response.url, 0, self.transferred(response), request=False)
+
+    @staticmethod
+    def transferred(response):
+        # bytes read from the connection, this is the compressed size if the response was compressed
+        try:
+            return response.raw.tell()
+        except Exception:
+            return len(response.content)
+
+    def record(self, url, latency, transferred, error=False, request=True):
+        host = urlparse(url).netloc
+        with self.lock:
+            metrics = self.host_metrics.setdefault(
+                host,
+                {
+                    "requests": 0,
+                    "errors": 0,
+                    "bytes": 0,
+                    "latency_sum": 0.0,
+                    "latency_buckets": [0] * len(LATENCY_BUCKETS),
+                },
+            )
+            metrics["bytes"] += transferred
+            if request:
+                metrics["requests"] += 1
+                metrics["errors"] += int(error)
+                metrics["latency_sum"] += latency
+                for i, bucket in enumerate(LATENCY_BUCKETS):
+                    if latency <= bucket:
+                        metrics["latency_buckets"][i] += 1
+                        break
+
+    def metrics(self):
+        """
+        copy of the metrics of each host
+        """
+        with self.lock:
+            return {
+                host: dict(metrics, latency_buckets=list(metrics["latency_buckets"]))
+                for host, metrics in self.host_metrics.items()
+            }
+
+    def log_metrics(self):
+        for host, metrics in self.metrics().items():
+            average = metrics["latency_sum"] / max(1, metrics["requests"])
+            histogram = ", ".join(
+                f"<={bucket}s: {count}"
+                for bucket, count in zip(LATENCY_BUCKETS, metrics["latency_buckets"])
+                if count > 0
+            )
+            logging.info(
+                f"HTTP {host}: {metrics['requests']} requests, {metrics['errors']} errors, "
+                f"{metrics['bytes'] / 1e6:.2f} MB transferred, average latency {average:.2f} s ({histogram})"
+            )
+
+
+def configure(pool_size=10, retries=3, backoff_factor=1, timeout=(10, 300)):
+    """
+    replace the shared client with one using these settings
+    """
+    global _client
+    with _client_lock:
+        _client = UsgsHttpClient(pool_size, retries, backoff_factor, timeout)
+        return _client
+
+
+def get_client():
+    """
+    get the shared client, it is created with the default settings if configure has not been called
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = UsgsHttpClient()
+        return _client
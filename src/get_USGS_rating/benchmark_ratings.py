@@ -0,0 +1,157 @@
+#!/bin/env python3
+# Benchmarks for the getUSGS_ratings_CDA script.  These do not connect to CDA or the USGS.
+# run program by typing python3 benchmark_ratings.py convert   -> rdb read and rating conversion of large synthetic tables
+#                       python3 benchmark_ratings.py tokenize  -> parse_ini_line on a large synthetic ini file
+# the tables are synthetic unless a USGS rating rdb file is given with --rdb-file, ie saved from
+# https://nwis.waterdata.usgs.gov/nwisweb/get_ratings?site_no=...&file_type=exsa
+# the ini file is synthetic unless one is given with --ini-file
+
+import time
+import numpy as np
+import pandas as pd
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import getUSGS_ratings_CDA
+import rating_ini_file_import
+from tests import parse_ini_line_charwise
+
+
+def convert_usgs_rating_df_groupby(df, rating_type):
+    """
+    groupby first/last conversion that convert_usgs_rating_df replaced, kept as the benchmark baseline
+    """
+    if rating_type == "CORR":
+        df = df.groupby("CORR")
+        df = pd.concat([df.first(), df.last()], ignore_index=True, join="inner")
+        df = df.sort_values(by=["INDEP"], ignore_index=True)
+    df = df.rename(columns={"INDEP": "ind", "CORRINDEP": "dep", "DEP": "dep"})
+    df_out = df[["ind", "dep"]].copy()
+    return df_out
+
+
+def synthetic_ini_lines(lines, seed=0):
+    """
+    build the lines of an ini file with a mix of quoted, escaped, tab separated and plain store lines between
+    keyword and comment lines
+    """
+    rng = np.random.default_rng(seed)
+    templates = [
+        'localid=LOC{i}',
+        'store_exsa  "USGS {i:08d}" \'Stage Flow\'  $($db_exsa)   # site {i}',
+        "store_corr  'C:\\\\ratings\\\\{i}.rdb'  $($db_corr)",
+        "store_base\t{i:08d}\t$($db_base)",
+        "store_exsa {i:08d} $($db_exsa)",
+        "# comment line {i}",
+    ]
+    choices = rng.integers(0, len(templates), lines)
+    return [templates[choice].format(i=i) + "\n" for i, choice in enumerate(choices)]
+
+
+RDB_HEADER = """# //UNITED STATES GEOLOGICAL SURVEY       https://water.usgs.gov/
+# //FILE TYPE="NWIS RATING"
+# //STATION AGENCY="USGS " NUMBER="00000000       " TIME_ZONE="CST" DST_FLAG=Y
+# //RATING SHIFTED="20240105123000 CST"
+# //RATING_DATETIME BEGIN=20240105123000 BEGIN_ZONE="CST" END=---------- END_ZONE="" AGING=Working
+# //CORR1_PREV BEGIN=20240105123000 BEGIN_ZONE="CST" END=---------- END_ZONE=""
+# //RETRIEVED: 2024-03-01 10:00:00 CST
+"""
+
+
+def synthetic_rdb(rating_type, rows):
+    """
+    build a USGS rdb rating file of rating_type with rows 0.01 ft steps.  The CORR shift rises and falls again so
+    the same shift appears in runs that are not next to each other
+    """
+    ind = np.round(np.arange(rows) / 100, 2)
+    if rating_type == "CORR":
+        shift = np.round(
+            np.interp(ind, [0, ind[-1] / 3, ind[-1]], [0.1, 0.6, 0.2]), 2
+        )
+        table = ["INDEP\tCORR\tCORRINDEP", "16N\t16N\t16N"] + [
+            f"{i:.2f}\t{s:.2f}\t{i + s:.2f}" for i, s in zip(ind, shift)
+        ]
+    else:
+        dep = 3.5 * (ind + 0.5) ** 2.2
+        table = ["INDEP\tSHIFT\tDEP\tSTOR", "16N\t16N\t16N\t1S"] + [
+            f"{i:.2f}\t0.10\t{d:.4f}\t" for i, d in zip(ind, dep)
+        ]
+    return RDB_HEADER + "\n".join(table) + "\n"
+
+
+def timed(function, *args, repeat=3):
+    """
+    best wall time in seconds of repeat calls to function and the result of the last call
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_convert(rating_type, text):
+    read_time, (header, df) = timed(getUSGS_ratings_CDA.read_usgs_rdb, text)
+    groupby_time, groupby = timed(convert_usgs_rating_df_groupby, df, rating_type)
+    vector_time, vector = timed(
+        getUSGS_ratings_CDA.convert_usgs_rating_df, df, rating_type
+    )
+    if rating_type == "CORR":
+        # the vectorized conversion must reproduce every point of the table
+        error = np.abs(
+            np.interp(df["INDEP"], vector["ind"], vector["dep"]) - df["CORRINDEP"]
+        ).max()
+        if error > 1e-9:
+            raise Exception(f"CORR breakpoints do not reproduce the table, error {error}")
+    elif not groupby.equals(vector):
+        raise Exception("convert_usgs_rating_df does not match the groupby conversion")
+    print(f"{rating_type} rating with {len(df)} rows -> {len(vector)} points ({len(groupby)} with groupby)")
+    print(f"  read rdb        : {read_time:.4f} s")
+    print(f"  groupby convert : {groupby_time:.4f} s")
+    print(f"  vector convert  : {vector_time:.4f} s")
+    print(f"  speedup         : {groupby_time / vector_time:.1f}x")
+
+
+def bench_tokenize(lines):
+    lines = [line[:-1].strip() for line in lines]
+    charwise_time, charwise = timed(lambda: [parse_ini_line_charwise(line) for line in lines])
+    split_time, split = timed(lambda: [rating_ini_file_import.parse_ini_line(line) for line in lines])
+    if charwise != split:
+        raise Exception("parse_ini_line does not match the character by character parser")
+    print(f"parse_ini_line on {len(lines)} lines")
+    print(f"  character loop  : {charwise_time:.4f} s")
+    print(f"  split tokenizer : {split_time:.4f} s")
+    print(f"  speedup         : {charwise_time / split_time:.1f}x")
+
+
+def main():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("benchmark", choices=["convert", "tokenize"], help="Benchmark to run")
+    parser.add_argument("-r", "--rows", default=20000, type=int, help="convert: Number of rows of the synthetic rating tables")
+    parser.add_argument("-t", "--rating-types", default=["EXSA", "CORR"], nargs="+", choices=["EXSA", "BASE", "CORR"], help="convert: Rating types to benchmark")
+    parser.add_argument("-f", "--rdb-file", default=None, type=str, help="convert: USGS rating rdb file to benchmark instead of the synthetic tables, the first rating type is used for it")
+    parser.add_argument("-l", "--lines", default=100000, type=int, help="tokenize: Number of lines of the synthetic ini file")
+    parser.add_argument("-i", "--ini-file", default=None, type=str, help="tokenize: ini file to benchmark instead of the synthetic file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the getUSGS_ratings_CDA log")
+    args = vars(parser.parse_args())
+
+    if not args["verbose"]:
+        getUSGS_ratings_CDA.logging.setLevel(getUSGS_ratings_CDA.lg.WARNING)
+
+    if args["benchmark"] == "tokenize":
+        if args["ini_file"] is not None:
+            with open(args["ini_file"], "r") as f:
+                bench_tokenize(f.readlines())
+        else:
+            bench_tokenize(synthetic_ini_lines(args["lines"]))
+    elif args["rdb_file"] is not None:
+        with open(args["rdb_file"], "r") as f:
+            bench_convert(args["rating_types"][0], f.read())
+    else:
+        for rating_type in args["rating_types"]:
+            bench_convert(rating_type, synthetic_rdb(rating_type, args["rows"]))
+
+
+if __name__ == "__main__":
+    main()
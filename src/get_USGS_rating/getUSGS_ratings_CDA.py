@@ -2,16 +2,25 @@
 # This getUSGS script works with CDA version 20250305.
 # and cwms-python version 0.6
 
+import io
+import os
+import json
+import hashlib
+import threading
 import logging as lg
+from copy import deepcopy
 import pandas as pd
 import numpy as np
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from json import loads
 import cwms
-from dataretrieval import nwis
-import requests
+from cwms.cwms_types import Data
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+import usgs_http
+
 
 # create logging for logging
 logging = lg.getLogger()
@@ -25,8 +34,28 @@ logging.addHandler(handler)
 logging.setLevel(lg.INFO)
 logging.propagate = False
 
+# USGS rating files, also lists the ratings updated over a period
+USGS_RATINGS_URL = "https://nwis.waterdata.usgs.gov/nwisweb/get_ratings"
+
 
-def getusgs_rating_cda(api_root, office_id, days_back, api_key):
+def getusgs_rating_cda(
+    api_root,
+    office_id,
+    days_back,
+    api_key,
+    fetch_workers=4,
+    store_workers=4,
+    rating_cache=None,
+    rating_cache_max_mb=500,
+    rating_cache_max_days=30,
+    compare_curves=False,
+    curve_tolerance=1e-6,
+    rating_id_mask=None,
+    spec_page_size=5000,
+    spec_cache=None,
+    spec_cache_ttl=24,
+    refresh_specs=False,
+):
     api_key = "apikey " + api_key
     cwms.api.init_session(api_root=api_root, api_key=api_key)
     logging.info(f"CDA connection: {api_root}")
@@ -37,7 +66,14 @@ def getusgs_rating_cda(api_root, office_id, days_back, api_key):
     logging.info(f"Execution date {execution_date}")
 
     logging.info("Getting Rating Specification information from CWMS Database")
-    rating_specs = get_rating_ids_from_specs(office_id)
+    rating_specs = get_rating_ids_from_specs_cached(
+        office_id,
+        spec_cache,
+        spec_cache_ttl,
+        refresh_specs,
+        rating_id_mask,
+        spec_page_size,
+    )
     USGS_ratings = get_location_aliases(
         rating_specs, "USGS Station Number", "Agency Aliases", "CWMS", None, None
     )
@@ -70,28 +106,163 @@ def getusgs_rating_cda(api_root, office_id, days_back, api_key):
             [updated_ratings, USGS_ratings_empty], ignore_index=True
         )
 
-    cwms_write_ratings(updated_ratings)
+    cache = None
+    if rating_cache is not None:
+        cache = RatingFileCache(
+            rating_cache, rating_cache_max_mb * 1e6, rating_cache_max_days
+        )
+    saved_ratings = cwms_write_ratings(
+        updated_ratings,
+        fetch_workers,
+        store_workers,
+        cache,
+        compare_curves,
+        curve_tolerance,
+    )
+    if saved_ratings and spec_cache is not None:
+        # the effective dates of the cached specs are out of date once a rating is stored
+        update_rating_spec_cache(office_id, spec_cache, saved_ratings)
+    if cache is not None:
+        cache.evict()
+        cache.log_stats()
+    usgs_http.get_client().log_metrics()
 
 
-def get_rating_ids_from_specs(office_id):
-    rating_types = ["EXSA", "CORR", "BASE"]
-    rating_specs = cwms.get_rating_specs(office_id=office_id).df
+def iter_rating_spec_pages(office_id, rating_id_mask=None, page_size=5000):
+    """
+    get the rating specs of the office from CDA one page at a time.  rating_id_mask is a regular expression of the
+    rating ids CDA returns, ie .*USGS.*  yields the specs of each page as a dataframe
+    """
+    params = {
+        "office": office_id,
+        "rating-id-mask": rating_id_mask,
+        "page-size": page_size,
+    }
+    while True:
+        response = cwms.api.get("ratings/spec", params)
+        yield Data(response, selector="specs").df
+        if not response.get("next-page"):
+            break
+        params["page"] = response["next-page"]
+
+
+def filter_usgs_rating_specs(rating_specs):
+    """
+    keep the active, auto-update rating specs with USGS-EXSA, USGS-CORR or USGS-BASE in the description and set
+    their rating-type
+    """
     if "effective-dates" not in rating_specs.columns:
         rating_specs["effective-dates"] = np.nan
-    rating_specs = rating_specs.dropna(subset=["description"])
-    for rating_type in rating_types:
-        rating_specs.loc[
-            rating_specs["description"].str.contains(f"USGS-{rating_type}"),
-            "rating-type",
-        ] = rating_type
+    if "description" not in rating_specs.columns:
+        return rating_specs.iloc[0:0]
+    rating_specs = rating_specs.dropna(subset=["description"]).copy()
+    rating_specs["rating-type"] = rating_specs["description"].str.extract(
+        r".*USGS-(EXSA|CORR|BASE)", expand=False
+    )
     rating_specs = rating_specs[
-        (rating_specs["rating-type"].isin(rating_types))
+        (rating_specs["rating-type"].notna())
         & (rating_specs["active"])
         & (rating_specs["auto-update"])
     ]
     return rating_specs
 
 
+def get_rating_ids_from_specs(office_id, rating_id_mask=None, page_size=5000):
+    """
+    get the USGS rating specs of the office.  The specs are filtered a page at a time so only the USGS specs are kept
+    in memory
+    """
+    pages = []
+    total = 0
+    for page in iter_rating_spec_pages(office_id, rating_id_mask, page_size):
+        total += len(page.index)
+        pages.append(filter_usgs_rating_specs(page))
+    rating_specs = pd.concat(pages, ignore_index=True)
+    logging.info(
+        f"{len(rating_specs.index)} of {total} rating specs for {office_id} are updated from the USGS"
+    )
+    return rating_specs
+
+
+def rating_spec_cache_file(office_id, cache_dir):
+    return os.path.join(cache_dir, f"usgs_rating_specs_{office_id}.pkl")
+
+
+def get_rating_ids_from_specs_cached(
+    office_id,
+    cache_dir,
+    ttl_hours=24,
+    refresh=False,
+    rating_id_mask=None,
+    page_size=5000,
+):
+    """
+    get the USGS rating specs of the office using an on disk cache.  The cached specs are used without contacting
+    CDA until they are older than ttl_hours or were read with a different rating_id_mask.  refresh forces the specs
+    to be read again, cache_dir can be None to not use a cache
+    """
+    if cache_dir is None:
+        return get_rating_ids_from_specs(office_id, rating_id_mask, page_size)
+    cache_file = rating_spec_cache_file(office_id, cache_dir)
+    if os.path.isfile(cache_file) and not refresh:
+        try:
+            cache = pd.read_pickle(cache_file)
+            age = datetime.now() - cache["created"]
+            if age < timedelta(hours=ttl_hours) and cache["mask"] == rating_id_mask:
+                logging.info(f"Rating specs loaded from cache for {office_id}")
+                return cache["rating_specs"]
+        except Exception as error:
+            logging.warning(f"Rating spec cache {cache_file} could not be read: {error}")
+
+    rating_specs = get_rating_ids_from_specs(office_id, rating_id_mask, page_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    pd.to_pickle(
+        {
+            "created": datetime.now(),
+            "mask": rating_id_mask,
+            "rating_specs": rating_specs,
+        },
+        cache_file,
+    )
+    return rating_specs
+
+
+def update_rating_spec_cache(office_id, cache_dir, saved_ratings):
+    """
+    add the effective date of each rating saved by cwms_write_ratings to the effective dates of its cached spec so the
+    next run does not store it again.  The cache is removed if it can not be updated, the specs are then read from
+    CDA by the next run
+    """
+    cache_file = rating_spec_cache_file(office_id, cache_dir)
+    if not os.path.isfile(cache_file):
+        return
+    saved_dates = {}
+    for rating_id, site, rating_type, effective_date in saved_ratings:
+        saved_dates.setdefault(rating_id, []).append(effective_date)
+    try:
+        cache = pd.read_pickle(cache_file)
+        rating_specs = cache["rating_specs"]
+        rating_specs["effective-dates"] = [
+            (list(dates) if isinstance(dates, list) else []) + saved_dates[rating_id]
+            if rating_id in saved_dates
+            else dates
+            for rating_id, dates in zip(
+                rating_specs["rating-id"], rating_specs["effective-dates"]
+            )
+        ]
+        temp_file = f"{cache_file}.tmp"
+        pd.to_pickle(cache, temp_file)
+        os.replace(temp_file, cache_file)
+        logging.info(
+            f"Effective dates of {len(saved_dates)} stored ratings updated in the rating spec cache"
+        )
+    except Exception as error:
+        logging.warning(
+            f"Rating spec cache {cache_file} could not be updated, it is removed: {error}"
+        )
+        os.remove(cache_file)
+
+
 def get_location_aliases(
     df, loc_group_id, category_id, office_id, category_office_id, group_office_id
 ):
@@ -119,11 +290,11 @@ def get_usgs_updated_ratings(period):
     Function to grab data from the USGS based off of dataretieve-python
     """
     # Get USGS data
-    base_url = "https://nwis.waterdata.usgs.gov/nwisweb/get_ratings"
+    base_url = USGS_RATINGS_URL
 
     query_dict = {"period": period, "format": "rdb"}
 
-    r = requests.get(base_url, params=query_dict)
+    r = usgs_http.get_client().get(base_url, params=query_dict)
     temp = pd.DataFrame(r.text.split("\n"))
     temp = temp[temp[0].str.startswith("USGS")]
     updated_ratings = temp[0].str.split("\t", expand=True)
@@ -138,6 +309,278 @@ def get_usgs_updated_ratings(period):
     return updated_ratings
 
 
+def get_usgs_rating_file(site, rating_type):
+    """
+    download the rdb rating file of rating_type (BASE, EXSA or CORR) for the USGS site
+    """
+    response = usgs_http.get_client().get(
+        USGS_RATINGS_URL,
+        params={"site_no": site, "file_type": str(rating_type).lower()},
+    )
+    response.raise_for_status()
+    return response.text
+
+
+@dataclass
+class RdbHeader:
+    """
+    metadata read from the "# //" comment lines at the top of a USGS rating rdb file.  The dates are the strings
+    in the file, ie 20240105123000
+    """
+
+    # TIME_ZONE of the STATION line converted with convert_tz
+    timezone: str = None
+    # date of the RATING SHIFTED line
+    rating_shifted: str = None
+    # last numeric BEGIN date of the RATING_DATETIME lines
+    rating_begin: str = None
+    # last numeric BEGIN date of the CORR1_PREV, CORR2_PREV and CORR3_PREV lines
+    corr_prev_begin: str = None
+    # date and time of the RETRIEVED line
+    retrieved: str = None
+
+
+def get_begin_date(line):
+    """
+    the BEGIN date of a header line, None if it is not a number (ie ----------)
+    """
+    timestr = line.split("BEGIN=")[1].split()[0].strip().replace('"', "")
+    return timestr if timestr.isdigit() else None
+
+
+def parse_usgs_rdb_header(lines):
+    """
+    read the header of a USGS rdb file in a single pass.  lines is an iterator over the lines of the file, it is read
+    up to the first line that is not a comment.  returns the RdbHeader and that line (None if the file only has comments)
+    """
+    header = RdbHeader()
+    for line in lines:
+        if not line.startswith("#"):
+            return header, line
+        if not line.startswith("# //"):
+            continue
+        if line.startswith("# //STATION AGENCY=") and header.timezone is None:
+            timezone = line.split("TIME_ZONE=")[1].split()[0].replace('"', "")
+            header.timezone = convert_tz(timezone)
+        elif line.startswith("# //RATING SHIFTED=") and header.rating_shifted is None:
+            header.rating_shifted = line.split("=")[1].replace('"', "").split()[0]
+        elif line.startswith("# //RATING_DATETIME BEGIN="):
+            header.rating_begin = get_begin_date(line) or header.rating_begin
+        elif line.startswith(
+            ("# //CORR1_PREV BEGIN=", "# //CORR2_PREV BEGIN=", "# //CORR3_PREV BEGIN=")
+        ):
+            header.corr_prev_begin = get_begin_date(line) or header.corr_prev_begin
+        elif line.startswith("# //RETRIEVED:") and header.retrieved is None:
+            # the date and time without the time zone abbreviation, the STATION TIME_ZONE is used
+            header.retrieved = " ".join(line.split("RETRIEVED: ")[1].split()[:2])
+    return header, None
+
+
+class RatingFileCache:
+    """
+    on disk cache of USGS rating files.  The files are stored by the sha256 of their content in cache_dir/objects and
+    an index file for each site and rating type holds the hash, the ETag and Last-Modified headers of the download and
+    the date the USGS last updated the rating.  A rating whose date updated matches the cached one is read from disk
+    without contacting the USGS, otherwise a conditional GET is made and the cached file is used if the USGS answers
+    304 Not Modified.  evict removes files not used for max_age_days and then the least recently used files until the
+    cache is smaller than max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=500e6, max_age_days=30):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age = timedelta(days=max_age_days)
+        self.lock = threading.Lock()
+        self.stats = {"cached": 0, "not_modified": 0, "downloaded": 0}
+
+    def index_file(self, site, rating_type):
+        return os.path.join(self.cache_dir, f"{site}_{str(rating_type).upper()}.json")
+
+    def object_file(self, digest):
+        return os.path.join(self.objects_dir, f"{digest}.rdb")
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def read_entry(self, site, rating_type):
+        try:
+            with open(self.index_file(site, rating_type), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def read_object(self, entry):
+        path = self.object_file(entry["sha256"])
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            return None
+        # the modified time marks when the file was last used for eviction
+        os.utime(path)
+        return text
+
+    def get(self, site, rating_type, date_updated=None):
+        """
+        get the rdb rating file of rating_type for the USGS site from the cache or the USGS
+        """
+        entry = self.read_entry(site, rating_type)
+        text = None if entry is None else self.read_object(entry)
+        if (
+            text is not None
+            and date_updated is not None
+            and entry.get("date_updated") == date_updated
+        ):
+            self.count("cached")
+            return text
+
+        headers = {}
+        if text is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = usgs_http.get_client().get(
+            USGS_RATINGS_URL,
+            params={"site_no": site, "file_type": str(rating_type).lower()},
+            headers=headers,
+        )
+        if response.status_code == 304 and text is not None:
+            self.count("not_modified")
+            if date_updated is not None:
+                entry["date_updated"] = date_updated
+                self.write_entry(site, rating_type, entry)
+            return text
+        response.raise_for_status()
+
+        text = response.text
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if not os.path.isfile(self.object_file(digest)):
+            write_atomic(self.object_file(digest), text)
+        self.write_entry(
+            site,
+            rating_type,
+            {
+                "sha256": digest,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "date_updated": date_updated,
+                "retrieved": datetime.now().isoformat(),
+            },
+        )
+        self.count("downloaded")
+        return text
+
+    def write_entry(self, site, rating_type, entry):
+        write_atomic(self.index_file(site, rating_type), json.dumps(entry, indent=1))
+
+    def evict(self):
+        """
+        remove the cached files not used for max_age_days, then the least recently used files until the cache is
+        smaller than max_bytes.  Index entries of removed files are downloaded again when next used
+        """
+        files = []
+        for name in os.listdir(self.objects_dir):
+            path = os.path.join(self.objects_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append([stat.st_mtime, stat.st_size, path])
+        files.sort()
+        oldest = (datetime.now() - self.max_age).timestamp()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if mtime >= oldest and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total = total - size
+            removed = removed + 1
+        if removed > 0:
+            logging.info(f"Removed {removed} rating files from the rating cache {self.cache_dir}")
+        return removed
+
+    def log_stats(self):
+        logging.info(
+            f"Rating cache: {self.stats['cached']} ratings read from the cache, {self.stats['not_modified']} not modified since cached and {self.stats['downloaded']} downloaded"
+        )
+
+
+def write_atomic(path, text):
+    # write to a temporary file first so a reader never sees a partly written file
+    temp_file = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_file, path)
+
+
+def read_usgs_rdb(text):
+    """
+    read a USGS rdb file.  returns the RdbHeader of the comment lines and the table as a dataframe.  The line of column
+    names is followed by a line of column formats (ie 16N, 1S), columns with an N format are numeric
+    """
+    lines = iter(text.splitlines())
+    header, first_line = parse_usgs_rdb_header(lines)
+    if first_line is None:
+        return header, pd.DataFrame()
+    lines = [first_line] + [line for line in lines if not line.startswith("#")]
+    if len(lines) < 2:
+        return header, pd.DataFrame()
+    columns = lines[0].split("\t")
+    formats = lines[1].split("\t")
+    rows = [line for line in lines[2:] if line.strip()]
+    if len(rows) == 0:
+        return header, pd.DataFrame(columns=columns)
+    df = pd.read_csv(
+        io.StringIO("\n".join(rows)), sep="\t", names=columns, dtype=str
+    )
+    for column, column_format in zip(columns, formats):
+        if column_format.endswith("N"):
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+    return header, df
+
+
+def fetch_usgs_rating(row, rating_cache=None):
+    """
+    download the USGS rating file of the row once and parse both the rating table and the effective date from it.
+    The file is read through rating_cache (RatingFileCache) if it is given.  returns [usgs_rating,
+    usgs_effective_date, error_type, error], error_type is None if the rating was read or usgsapi, usgsempty or
+    usgseffective
+    """
+    logging.info(f'Getting data for rating ID = {row["rating-id"]}')
+    logging.info(
+        f'Getting data from USGS for USGS ID = {row["USGS_St_Num"]}, Rating Type = {row["rating-type"]}'
+    )
+    try:
+        if rating_cache is not None:
+            # ratings of new specs do not have a USGS update date
+            date_updated = row.get("date_updated")
+            text = rating_cache.get(
+                row["USGS_St_Num"],
+                row["rating-type"],
+                date_updated if pd.notna(date_updated) else None,
+            )
+        else:
+            text = get_usgs_rating_file(row["USGS_St_Num"], row["rating-type"])
+        header, usgs_rating = read_usgs_rdb(text)
+    except Exception as error:
+        return [None, None, "usgsapi", error]
+    if usgs_rating.empty:
+        return [usgs_rating, None, "usgsempty", None]
+    try:
+        usgs_effective_date = get_usgs_effective_date(header, row["rating-type"])
+    except Exception as error:
+        return [usgs_rating, None, "usgseffective", error]
+    return [usgs_rating, usgs_effective_date, None, None]
+
+
 def convert_tz(tz: str):
     if tz in ("AST", "ADT"):
         tzid = "America/Halifax"
@@ -158,60 +601,242 @@ def convert_tz(tz: str):
     return tzid
 
 
-def get_usgs_tz(data):
-    line = data[data[0].str.startswith("# //STATION AGENCY=")].iloc[0, 0]
-    timezone = line.split("TIME_ZONE=")[1].split()[0].replace('"', "")
-    timezone = convert_tz(timezone)
-    return timezone
-
-
-def get_begin_with_date(data, str_starts):
-    date_string = None
-    lines = data[data[0].str.startswith(str_starts)]
-    for _, line in lines.iterrows():
-        timestr = line[0].split("BEGIN=")[1].split()[0].strip().replace('"', "")
-        if timestr.isdigit():
-            date_string = timestr
-    return date_string
-
-
-def get_usgs_effective_date(data, rating_type):
-
+def get_usgs_effective_date(header, rating_type):
+    """
+    effective date of a USGS rating from its RdbHeader.  The RETRIEVED date is used if the header does not have a
+    date for the rating type
+    """
     date_string = None
     if rating_type == "EXSA":
-        line = data[data[0].str.startswith("# //RATING SHIFTED=")].iloc[0, 0]
-        rating_shifted_date = line.split("=")[1].replace('"', "")
-        date_string = rating_shifted_date.split()[0]
+        if header.rating_shifted is None:
+            raise ValueError("RATING SHIFTED not found in the USGS rating header")
+        date_string = header.rating_shifted
 
     elif rating_type == "BASE":
-        date_string = get_begin_with_date(data, ("# //RATING_DATETIME BEGIN="))
+        date_string = header.rating_begin
 
     elif rating_type == "CORR":
-        date_string = get_begin_with_date(
-            data,
-            ("# //CORR1_PREV BEGIN=", "# //CORR2_PREV BEGIN=", "# //CORR3_PREV BEGIN="),
-        )
+        date_string = header.corr_prev_begin
 
     if date_string is None:
-        line = data[data[0].str.startswith("# //RETRIEVED:")].iloc[0, 0]
-        date_string = line.split("RETRIEVED: ")[1]
+        if header.retrieved is None:
+            raise ValueError("RETRIEVED not found in the USGS rating header")
+        date_string = header.retrieved
 
-    timezone = get_usgs_tz(data)
-    dt = pd.to_datetime(date_string).tz_localize(timezone).floor("Min")
+    if header.timezone is None:
+        raise ValueError("TIME_ZONE not found in the USGS rating header")
+    dt = pd.to_datetime(date_string).tz_localize(header.timezone).floor("Min")
     return dt
 
 
+@dataclass(frozen=True)
+class RatingSchema:
+    """
+    columns of a USGS rating rdb table that are stored as the ind/dep points of the CWMS rating
+    """
+
+    ind: str
+    dep: str
+    # column that is constant over runs of rows, only the first and last row of each run are kept
+    breakpoints: str = None
+    # dep has to increase with ind
+    dep_increasing: bool = True
+
+
+RATING_SCHEMAS = {
+    "EXSA": RatingSchema(ind="INDEP", dep="DEP"),
+    "BASE": RatingSchema(ind="INDEP", dep="DEP"),
+    # the shift is interpolated between the correction points and rounded, so the table is a staircase of
+    # constant shifts and only the ends of each step are needed
+    "CORR": RatingSchema(
+        ind="INDEP", dep="CORRINDEP", breakpoints="CORR", dep_increasing=False
+    ),
+}
+
+
+def run_breakpoints(values):
+    """
+    mask of the first and last element of every run of equal values
+    """
+    keep = np.ones(len(values), dtype=bool)
+    if len(values) > 2:
+        change = values[1:] != values[:-1]
+        keep[1:-1] = change[1:] | change[:-1]
+    return keep
+
+
 def convert_usgs_rating_df(df, rating_type):
-    if rating_type == "CORR":
-        df = df.groupby("CORR")
-        df = pd.concat([df.first(), df.last()], ignore_index=True, join="inner")
-        df = df.sort_values(by=["INDEP"], ignore_index=True)
-    df = df.rename(columns={"INDEP": "ind", "CORRINDEP": "dep", "DEP": "dep"})
-    df_out = df[["ind", "dep"]].copy()
-    return df_out
+    """
+    convert a USGS rating table read by read_usgs_rdb to the ind/dep points of a CWMS rating using RATING_SCHEMAS.
+    Raises ValueError if a column is missing, a value is not a number or the curve is not monotonic
+    """
+    schema = RATING_SCHEMAS[rating_type]
+    columns = [schema.ind, schema.dep] + (
+        [schema.breakpoints] if schema.breakpoints else []
+    )
+    missing = [column for column in columns if column not in df.columns]
+    if missing:
+        raise ValueError(f"{rating_type} rating is missing the columns {missing}")
+    ind = df[schema.ind].to_numpy(dtype=float)
+    dep = df[schema.dep].to_numpy(dtype=float)
+    if not (np.isfinite(ind).all() and np.isfinite(dep).all()):
+        raise ValueError(f"{rating_type} rating has values that are not numbers")
+
+    if schema.breakpoints:
+        shift = df[schema.breakpoints].to_numpy(dtype=float)
+        if (np.diff(ind) < 0).any():
+            order = np.argsort(ind, kind="stable")
+            ind, dep, shift = ind[order], dep[order], shift[order]
+        keep = run_breakpoints(shift)
+        ind, dep = ind[keep], dep[keep]
+
+    if (np.diff(ind) <= 0).any():
+        raise ValueError(f"{rating_type} rating ind values are not increasing")
+    if schema.dep_increasing and (np.diff(dep) < 0).any():
+        raise ValueError(f"{rating_type} rating dep values decrease")
+    return pd.DataFrame({"ind": ind, "dep": dep})
+
+
+def rating_curve_points(df):
+    """
+    the ind/dep points of a rating curve as a float array of shape (n, 2) sorted by ind
+    """
+    points = df[["ind", "dep"]].to_numpy(dtype=float)
+    return points[np.argsort(points[:, 0], kind="stable")]
+
+
+def cwms_rating_curve_points(rating_json):
+    """
+    the ind/dep points of the rating-points of a CWMS simple rating json, sorted by ind
+    """
+    points = rating_json["simple-rating"].get("rating-points") or {}
+    df = pd.DataFrame(points.get("point") or [], columns=["ind", "dep"])
+    return rating_curve_points(df)
+
+
+def rating_curves_equal(usgs_points, cwms_points, tolerance):
+    """
+    True if both curves have the same number of points and every ind and dep value is within tolerance
+    """
+    if usgs_points.shape != cwms_points.shape:
+        return False
+    return bool(np.allclose(usgs_points, cwms_points, rtol=0, atol=tolerance))
+
+
+def fetch_cwms_rating(row, executor, current_ratings, compare_curves=False):
+    """
+    start getting the current CWMS rating of the row if it is needed to store the new USGS curve, ie
+    auto-migrate-extension is set and its extension is copied to the new curve, or compare_curves is set and its points
+    are compared with the USGS curve.  The future of the cwms.get_ratings call is added to current_ratings keyed by
+    office-id, rating-id and effective date.  Only called for ratings whose USGS effective date is new so ratings that
+    are up to date are not read from CWMS
+    """
+    if pd.isna(row["cwms_max_effective_date"]):
+        return
+    if not (compare_curves or row["auto-migrate-extension"] == True):
+        return
+    key = (row["office-id"], row["rating-id"], row["cwms_max_effective_date"])
+    if key not in current_ratings:
+        current_ratings[key] = executor.submit(
+            cwms.get_ratings,
+            rating_id=row["rating-id"],
+            office_id=row["office-id"],
+            begin=row["cwms_max_effective_date"],
+            end=row["cwms_max_effective_date"],
+            method="EAGER",
+            single_rating_df=True,
+        )
+
+
+def store_usgs_rating(
+    row,
+    usgs_rating,
+    usgs_effective_date,
+    current_ratings,
+    compare_curves=False,
+    curve_tolerance=1e-6,
+):
+    """
+    store the USGS rating curve to the CWMS rating of the row.  current_ratings are the futures of the current CWMS
+    ratings from fetch_cwms_rating.  If compare_curves is set the rating is not stored when its points are the
+    same as the current CWMS curve within curve_tolerance.  returns [stored, error], stored is False without an error
+    when the curve was the same
+    """
+    rating_units = {"EXSA": "ft;cfs", "BASE": "ft;cfs", "CORR": "ft;ft"}
+    cwms_effective_date = row["cwms_max_effective_date"]
+    try:
+        usgs_store_rating = convert_usgs_rating_df(
+            usgs_rating, row["rating-type"]
+        )
+
+        current_rating = None
+        key = (row["office-id"], row["rating-id"], cwms_effective_date)
+        if key in current_ratings:
+            current_rating = current_ratings[key].result()
+
+        if compare_curves and current_rating is not None:
+            if rating_curves_equal(
+                rating_curve_points(usgs_store_rating),
+                cwms_rating_curve_points(current_rating.json),
+                curve_tolerance,
+            ):
+                logging.info(
+                    f'Rating curve for rating id = {row["rating-id"]} is the same as the CWMS curve effective {cwms_effective_date}, it will not be saved'
+                )
+                return [False, None]
 
+        if row["auto-migrate-extension"] and current_rating is not None:
+            # the fetched json is copied as it is changed below
+            rating_json = deepcopy(current_rating.json)
+            points_json = loads(usgs_store_rating.to_json(orient="records"))
+            rating_json["simple-rating"]["rating-points"] = {
+                "point": points_json
+            }
+            rating_json["simple-rating"][
+                "effective-date"
+            ] = usgs_effective_date.isoformat()
+            del rating_json["simple-rating"]["create-date"]
+            rating_json["simple-rating"]["active"] = row["auto-activate"]
+        else:
+            rating_json = cwms.rating_simple_df_to_json(
+                data=usgs_store_rating,
+                rating_id=row["rating-id"],
+                office_id=row["office-id"],
+                units=rating_units[row["rating-type"]],
+                effective_date=usgs_effective_date,
+                active=row["auto-activate"],
+            )
+        response = cwms.update_ratings(
+            data=rating_json, rating_id=row["rating-id"]
+        )
+        logging.info(
+            f'SUCCESS Stored rating for rating id = {row["rating-id"]}, effective date = {usgs_effective_date}'
+        )
+        return [True, None]
+    except Exception as error:
+        logging.error(
+            f'FAIL Data could not be stored to CWMS database for -->  {row["rating-id"]},{row["USGS_St_Num"]}, {row["rating-type"]} CDA error = {error}'
+        )
+        return [False, error]
 
-def cwms_write_ratings(updated_ratings):
+
+def cwms_write_ratings(
+    updated_ratings,
+    fetch_workers=4,
+    store_workers=4,
+    rating_cache=None,
+    compare_curves=False,
+    curve_tolerance=1e-6,
+):
+    """
+    download the USGS rating of each row of updated_ratings with fetch_workers parallel requests and store the ratings
+    with a new effective date to CWMS with store_workers parallel requests.  Ratings are stored as soon as they are
+    downloaded.  rating_cache is an optional RatingFileCache the rating files are read through.  The current CWMS
+    rating needed for auto-migrate-extension is read with store_workers parallel requests once the USGS rating is
+    downloaded and its effective date is new.  With compare_curves a rating with a new effective date is only stored if its points
+    differ from the current CWMS curve by more than curve_tolerance.  returns [rating-id, USGS_St_Num, rating-type,
+    effective date] of the ratings that were saved
+    """
     storErr = []
     usgsapiErr = []
     usgsemptyErr = []
@@ -220,39 +845,40 @@ def cwms_write_ratings(updated_ratings):
     saved = 0
     saved_ratings = []
     same_effective = 0
+    same_curve_ratings = []
 
-    rating_units = {"EXSA": "ft;cfs", "BASE": "ft;cfs", "CORR": "ft;ft"}
-    for _, row in updated_ratings.iterrows():
-        logging.info(f'Getting data for rating ID = {row["rating-id"]}')
-        logging.info(
-            f'Getting data from USGS for USGS ID = {row["USGS_St_Num"]}, Rating Type = {row["rating-type"]}'
-        )
-        try:
-            usgs_rating, meta = nwis.get_ratings(
-                site=row["USGS_St_Num"], file_type=str(row["rating-type"]).lower()
-            )
-            url = meta.url
-        except Exception as error:
-            usgsapiErr.append(
-                [row["rating-id"], row["USGS_St_Num"], row["rating-type"], error]
-            )
-            logging.error(
-                f'FAIL Error collecting rating data from USGS for -->  {row["rating-id"]},{row["USGS_St_Num"]}, {row["rating-type"]} USGS error = {error}'
-            )
-            continue
-        if usgs_rating.empty:
-            logging.warning(
-                f'Empty rating obtained from USGS for USGS ID = {row["USGS_St_Num"]}, Rating Type = {row["rating-type"]}, url'
-            )
-            usgsemptyErr.append(
-                [row["rating-id"], row["USGS_St_Num"], row["rating-type"]]
-            )
-        else:
-            try:
-                response = requests.get(url)
-                temp = pd.DataFrame(response.text.split("\n"))
-                usgs_effective_date = get_usgs_effective_date(temp, row["rating-type"])
-            except Exception as error:
+    with ThreadPoolExecutor(max_workers=max(1, fetch_workers)) as fetch_pool, ThreadPoolExecutor(
+        max_workers=max(1, store_workers)
+    ) as store_pool, ThreadPoolExecutor(
+        max_workers=max(1, store_workers)
+    ) as cwms_fetch_pool:
+        current_ratings = {}
+        fetches = {
+            fetch_pool.submit(fetch_usgs_rating, row, rating_cache): row
+            for _, row in updated_ratings.iterrows()
+        }
+        stores = {}
+        # the results are collected in this thread so the lists do not need to be locked
+        for future in as_completed(fetches):
+            row = fetches[future]
+            usgs_rating, usgs_effective_date, error_type, error = future.result()
+            if error_type == "usgsapi":
+                usgsapiErr.append(
+                    [row["rating-id"], row["USGS_St_Num"], row["rating-type"], error]
+                )
+                logging.error(
+                    f'FAIL Error collecting rating data from USGS for -->  {row["rating-id"]},{row["USGS_St_Num"]}, {row["rating-type"]} USGS error = {error}'
+                )
+                continue
+            if error_type == "usgsempty":
+                logging.warning(
+                    f'Empty rating obtained from USGS for USGS ID = {row["USGS_St_Num"]}, Rating Type = {row["rating-type"]}, url'
+                )
+                usgsemptyErr.append(
+                    [row["rating-id"], row["USGS_St_Num"], row["rating-type"]]
+                )
+                continue
+            if error_type == "usgseffective":
                 usgseffectiveErr.append(
                     [row["rating-id"], row["USGS_St_Num"], row["rating-type"], error]
                 )
@@ -272,67 +898,55 @@ def cwms_write_ratings(updated_ratings):
                 )
                 same_effective = same_effective + 1
             else:
-                try:
-                    usgs_store_rating = convert_usgs_rating_df(
-                        usgs_rating, row["rating-type"]
+                fetch_cwms_rating(row, cwms_fetch_pool, current_ratings, compare_curves)
+                stores[
+                    store_pool.submit(
+                        store_usgs_rating,
+                        row,
+                        usgs_rating,
+                        usgs_effective_date,
+                        current_ratings,
+                        compare_curves,
+                        curve_tolerance,
                     )
+                ] = [row, usgs_effective_date]
 
-                    if row["auto-migrate-extension"] and pd.notna(cwms_effective_date):
-                        current_rating = cwms.get_ratings(
-                            rating_id=row["rating-id"],
-                            office_id=row["office-id"],
-                            begin=cwms_effective_date,
-                            end=cwms_effective_date,
-                            method="EAGER",
-                            single_rating_df=True,
-                        )
-                        rating_json = current_rating.json
-                        points_json = loads(usgs_store_rating.to_json(orient="records"))
-                        rating_json["simple-rating"]["rating-points"] = {
-                            "point": points_json
-                        }
-                        rating_json["simple-rating"][
-                            "effective-date"
-                        ] = usgs_effective_date.isoformat()
-                        del rating_json["simple-rating"]["create-date"]
-                        rating_json["simple-rating"]["active"] = row["auto-activate"]
-                    else:
-                        rating_json = cwms.rating_simple_df_to_json(
-                            data=usgs_store_rating,
-                            rating_id=row["rating-id"],
-                            office_id=row["office-id"],
-                            units=rating_units[row["rating-type"]],
-                            effective_date=usgs_effective_date,
-                            active=row["auto-activate"],
-                        )
-                    response = cwms.update_ratings(
-                        data=rating_json, rating_id=row["rating-id"]
-                    )
-                    logging.info(
-                        f'SUCCESS Stored rating for rating id = {row["rating-id"]}, effective date = {usgs_effective_date}'
-                    )
-                    saved = saved + 1
-                    saved_ratings.append(
-                        [row["rating-id"], row["USGS_St_Num"], row["rating-type"]]
-                    )
-                except Exception as error:
-                    storErr.append(
-                        [
-                            row["rating-id"],
-                            row["USGS_St_Num"],
-                            row["rating-type"],
-                            error,
-                        ]
-                    )
-                    logging.error(
-                        f'FAIL Data could not be stored to CWMS database for -->  {row["rating-id"]},{row["USGS_St_Num"]}, {row["rating-type"]} CDA error = {error}'
-                    )
+        for future in as_completed(stores):
+            row, usgs_effective_date = stores[future]
+            stored, error = future.result()
+            if stored:
+                saved = saved + 1
+                saved_ratings.append(
+                    [
+                        row["rating-id"],
+                        row["USGS_St_Num"],
+                        row["rating-type"],
+                        usgs_effective_date.isoformat(),
+                    ]
+                )
+            elif error is None:
+                same_curve_ratings.append(
+                    [row["rating-id"], row["USGS_St_Num"], row["rating-type"]]
+                )
+            else:
+                storErr.append(
+                    [
+                        row["rating-id"],
+                        row["USGS_St_Num"],
+                        row["rating-type"],
+                        error,
+                    ]
+                )
     logging.info(
         f"A total of {total_recs} ratings were updated by the USGS over the lookback period."
     ) 
     logging.info(
         f"Of those {total_recs} ratings {same_effective} were already stored in the CWMS database"
     )    
+    if len(same_curve_ratings) > 0:
+        logging.info(
+            f"A total of {len(same_curve_ratings)} ratings had a new effective date but the same curve as the CWMS database and were not saved: {same_curve_ratings}"
+        )
     if len(saved_ratings) > 0:
         logging.info(
             f"A total of {saved} ratings were new and saved successfully to the database"
@@ -356,6 +970,7 @@ def cwms_write_ratings(updated_ratings):
         logging.info(
             f"The following ratings errored when trying to store to CDA: {storErr}"
         )
+    return saved_ratings
 
 def main():
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
@@ -364,6 +979,18 @@ def main():
     parser.add_argument("-a", "--api_root", required=True, type=str, help="Api Root for CDA (Required).")
     parser.add_argument("-k", "--api_key", default=None, type=str, help="api key. one of api_key or api_key_loc are required")
     parser.add_argument("-kl", "--api_key_loc", default=None, type=str, help="file storing Api Key. One of api_key or api_key_loc are required")
+    parser.add_argument("--fetch-workers", default=4, type=int, help="Number of rating files downloaded from the USGS in parallel")
+    parser.add_argument("--store-workers", default=4, type=int, help="Number of ratings stored to CDA in parallel")
+    parser.add_argument("-c", "--rating-cache", default=None, type=str, help="Directory to cache the USGS rating files in. Caching is off if not set")
+    parser.add_argument("--rating-cache-max-mb", default=500, type=float, help="Maximum size of the rating cache in MB, the least recently used files are removed first")
+    parser.add_argument("--rating-cache-max-days", default=30, type=float, help="Days a cached rating file is kept after it was last used")
+    parser.add_argument("--compare-curves", action="store_true", help="Compare the points of a USGS rating with a new effective date to the current CWMS curve and skip storing it if they are the same")
+    parser.add_argument("--curve-tolerance", default=1e-6, type=float, help="Largest difference between ind or dep values of two rating curves that are considered the same by --compare-curves")
+    parser.add_argument("-m", "--rating-id-mask", default=None, type=str, help="Regular expression of the rating ids requested from CDA, ie .*USGS.*  All rating specs of the office are requested if not set")
+    parser.add_argument("--spec-page-size", default=5000, type=int, help="Number of rating specs requested from CDA in a single call")
+    parser.add_argument("--spec-cache", default=None, type=str, help="Directory to cache the USGS rating specs in between runs. Caching is off if not set")
+    parser.add_argument("--spec-cache-ttl", default=24, type=float, help="Hours the cached rating specs are used before they are requested from CDA again. The effective dates of the ratings stored by a run are added to the cached specs, the cache is only cleared if it can not be updated")
+    parser.add_argument("--refresh-specs", action="store_true", help="Request the rating specs from CDA even if they are cached")
     args = vars(parser.parse_args())
 
     OFFICE = args["office"]
@@ -389,6 +1016,18 @@ def main():
         office_id=OFFICE,
         days_back=DAYS_BACK,
         api_key=APIKEY,
+        fetch_workers=args["fetch_workers"],
+        store_workers=args["store_workers"],
+        rating_cache=args["rating_cache"],
+        rating_cache_max_mb=args["rating_cache_max_mb"],
+        rating_cache_max_days=args["rating_cache_max_days"],
+        compare_curves=args["compare_curves"],
+        curve_tolerance=args["curve_tolerance"],
+        rating_id_mask=args["rating_id_mask"],
+        spec_page_size=args["spec_page_size"],
+        spec_cache=args["spec_cache"],
+        spec_cache_ttl=args["spec_cache_ttl"],
+        refresh_specs=args["refresh_specs"],
     )
            
 if __name__ == "__main__":
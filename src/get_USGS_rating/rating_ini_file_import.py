@@ -2,18 +2,13 @@
 # This getUSGS script works with CDA version 20250305
 # and cwms-python version 0.6
 
+import re
 import pandas as pd
 import cwms
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import logging
 
-parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
-parser.add_argument("-f", "--filename", default="1", help="fileaname of ini file to be processed")
-parser.add_argument("-a", "--api_root", required=True, type=str, help="Api Root for CDA (Required).")
-parser.add_argument("-k", "--api_key", default=None, type=str, help="api key. one of api_key or api_key_loc are required")
-parser.add_argument("-kl", "--api_key_loc", default=None, type=str, help="file storing Api Key. One of api_key or api_key_loc are required")
-args = vars(parser.parse_args())
-
 # create logger for logging
 logger = logging.getLogger()
 if (logger.hasHandlers()):
@@ -26,28 +21,6 @@ logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 logger.propagate = False
 
-APIROOT = args["api_root"]
-# place a file in .cwms names api_key that holds you apikey
-# to be used to write data to the database using CDA
-if args["api_key_loc"] is not None:
-    api_key_loc = args["api_key_loc"]
-    with open(api_key_loc, "r") as f:
-        APIKEY = f.readline().strip()
-elif args["api_key"] is not None:
-    APIKEY=args["api_key"]
-else:
-    raise Exception("must add a value to either --api_key(-a) or --api_key_loc(-al)") 
-
-# Days back is defined as a argument to the program.
-# run program by typing python3 getUSGS.py 5
-# the 5 would mean grab data starting 5 days ago to now
-INI_FILENAME = args["filename"]
-
-# import CWMS module and assign the apiROOT and apikey to be
-# used throughout the program
-apiKey = "apikey " + APIKEY
-api = cwms.api.init_session(api_root=APIROOT, api_key=apiKey)
-
 
 rating_types = {'store_corr': 
             {'db_type':'db_corr', 'db_disc':'USGS-CORR'},
@@ -56,6 +29,32 @@ rating_types = {'store_corr':
             'store_exsa':
             {'db_type':'db_exsa', 'db_disc':'USGS-EXSA'}}
 
+# values every rating spec updated from the USGS has
+usgs_spec_values = {'source-agency': 'USGS',
+                    'active': True,
+                    'auto-update': True,
+                    'auto-activate': True}
+
+quote_split = re.compile(r"""(["'])""")
+whitespace = re.compile(r"\s")
+
+def drop_escapes(line) :
+    '''
+    Removes the escaping backslashes of a line.  Every other backslash is an escape, starting with the first one,
+    so a pair of backslashes gives a single backslash
+    '''
+    parts = line.split("\\")
+    return "\\".join(["".join(parts[i:i+2]) for i in range(0, len(parts), 2)])
+
+def hide_spaces(text) :
+    '''
+    Replaces the whitespace in a quoted part of a line with chr(0) so it is not split
+    '''
+    if text.isprintable() :
+        # the only printable whitespace is a space
+        return text.replace(" ", chr(0))
+    return whitespace.sub(chr(0), text)
+
 def parse_ini_line(line) :
     '''
     Parses a line in the ini_file into fields
@@ -64,28 +63,28 @@ def parse_ini_line(line) :
         #---------------------------#
         # fields with spaces quoted #
         #---------------------------#
-        c1 = [c for c in line]
-        escape = False
-        quote = None
-        c2 = []
-        for c in c1 :
-            if c == '\\' :
-                escape = not escape
-                if not escape : c2.append(c)
-                continue
-            if c in ('"', "'") :
-                if not quote :
-                    quote = c
-                    continue
-                if c == quote :
-                    quote = None
-                    continue
-            if c.isspace() and quote :
-                c = chr(0)
-            c2.append(c)
-        fields = "".join(c2).split()
-        for i in range(len(fields)) :
-            fields[i] = fields[i].replace(chr(0), " ")
+        if "\\" in line :
+            line = drop_escapes(line)
+        if "'" in line and '"' in line :
+            # a quote of the other kind inside a quoted part is kept
+            quote = None
+            pieces = []
+            for piece in quote_split.split(line) :
+                if piece == '"' or piece == "'" :
+                    if not quote :
+                        quote = piece
+                        continue
+                    if piece == quote :
+                        quote = None
+                        continue
+                elif quote :
+                    piece = hide_spaces(piece)
+                pieces.append(piece)
+        else :
+            # every other piece between quotes is quoted, a quote that is not closed runs to the end of the line
+            pieces = line.split("'" if "'" in line else '"')
+            pieces[1::2] = [hide_spaces(piece) for piece in pieces[1::2]]
+        fields = [field.replace(chr(0), " ") for field in "".join(pieces).split()]
     elif line.find("\t") > 0 :
         #------------------------------------------------------------#
         # all fields without spaces separated by tabs (version < 5.0 #
@@ -98,37 +97,12 @@ def parse_ini_line(line) :
         fields = line.split()
     return fields
 
-def update_rating_spec(rating_id, office_id, db_disc):
-    rating_spec = cwms.get_rating_spec(rating_id=rating_id,office_id=office_id)
-    data = rating_spec.df
-    data = data.drop('effective-dates',axis=1)
-    logger.info(f'Setting source-agency to USGS')
-    data['source-agency'] = 'USGS'
-    logger.info(f'Setting Active, Auto-update, Auto-Activate to True')
-    data['active'] = True
-    data['auto-update'] = True
-    data['auto-activate'] = True
-    if 'description' in data.columns:
-        if db_disc not in data.loc[0,'description']:
-            data['description'] = data['description'] + ' ' + db_disc
-    else:
-        data['description'] = db_disc
-    disc = data.loc[0,'description']
-    logger.info(f'Saving specification discription as: {disc}')
-    data_xml = cwms.rating_spec_df_to_xml(data)
-    cwms.store_rating_spec(data=data_xml, fail_if_exists=False)
-
-
-def main():
-    logger.info(f"CDA connection: {APIROOT}")
-    logger.info(f"Opening ini file: {INI_FILENAME}")
-    ini_file = open(INI_FILENAME, "r")
-    lines = ini_file.readlines()
-    ini_file.close()
-
+def iter_ini_rating_specs(lines):
+    '''
+    Reads the lines of an ini file and yields [rating_spec, office_id, db_disc] of each rating stored from the USGS
+    '''
     params = {}
     keywords = ['cwms_office','db_base','db_exsa','db_corr','localid']
-    rating_errors = []
     for i in range(len(lines)) :
         line = lines[i][:-1].strip()
         try :
@@ -146,13 +120,158 @@ def main():
                 rating_db_type = rating_types[fields[0]]['db_type']
                 if f'$(${rating_db_type})' in fields:
                     rating_spec = params[rating_db_type].replace('\$localid', params['localid'])
-                    logger.info(f'Updating rating specification: {rating_spec}')
-                    try:
-                        update_rating_spec(rating_spec, params['cwms_office'], rating_types[fields[0]]['db_disc'])
-                        logger.info('SUCCESS: rating specification changes stored')
-                    except:
-                        logger.error('ERROR: rating specificataion could not be update')
-                        rating_errors.append([rating_spec, rating_types[fields[0]]['db_disc']])
+                    yield [rating_spec, params['cwms_office'], rating_types[fields[0]]['db_disc']]
+
+def set_usgs_spec_values(data, db_discs):
+    '''
+    Sets the values of a rating spec dataframe from cwms.get_rating_spec that are needed to update it from the USGS
+    and adds each of db_discs to the description.  Returns the updated spec and the changes as {field: [old, new]}
+    '''
+    data = data.drop('effective-dates',axis=1,errors='ignore')
+    changes = {}
+    for field, value in usgs_spec_values.items():
+        old = data.loc[0,field] if field in data.columns else None
+        if old != value:
+            changes[field] = [old, value]
+        data[field] = value
+    old = data.loc[0,'description'] if 'description' in data.columns else None
+    disc = old if isinstance(old, str) else None
+    for db_disc in db_discs:
+        if disc is None:
+            disc = db_disc
+        elif db_disc not in disc:
+            disc = disc + ' ' + db_disc
+    if disc != old:
+        changes['description'] = [old, disc]
+    data['description'] = disc
+    return data, changes
+
+def store_rating_spec(data):
+    data_xml = cwms.rating_spec_df_to_xml(data)
+    cwms.store_rating_spec(data=data_xml, fail_if_exists=False)
+
+def update_rating_spec(rating_id, office_id, db_disc):
+    rating_spec = cwms.get_rating_spec(rating_id=rating_id,office_id=office_id)
+    logger.info(f'Setting source-agency to USGS')
+    logger.info(f'Setting Active, Auto-update, Auto-Activate to True')
+    data, changes = set_usgs_spec_values(rating_spec.df, [db_disc])
+    disc = data.loc[0,'description']
+    logger.info(f'Saving specification discription as: {disc}')
+    store_rating_spec(data)
+
+def get_rating_spec_changes(rating_id, office_id, db_discs):
+    '''
+    Gets the rating spec and returns it updated from the USGS with the changes made, see set_usgs_spec_values
+    '''
+    rating_spec = cwms.get_rating_spec(rating_id=rating_id,office_id=office_id)
+    return set_usgs_spec_values(rating_spec.df, db_discs)
+
+def bulk_update_rating_specs(lines, workers=8, dry_run=False):
+    '''
+    Parses the whole ini file first and updates each rating spec once.  The specs are read from CDA with workers
+    parallel requests, specs that already have the USGS values are skipped and the changed specs are stored with
+    workers parallel requests.  With dry_run the changes are only reported.  Returns the rating specs that errored
+    '''
+    specs = {}
+    total = 0
+    for rating_spec, office_id, db_disc in iter_ini_rating_specs(lines):
+        total += 1
+        db_discs = specs.setdefault((office_id, rating_spec), [])
+        if db_disc not in db_discs:
+            db_discs.append(db_disc)
+    logger.info(f'{total} rating specifications in the ini file, {len(specs)} unique')
+
+    rating_errors = []
+    unchanged = 0
+    stored = 0
+    changed = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as fetch_pool, ThreadPoolExecutor(max_workers=max(1, workers)) as store_pool:
+        fetches = {fetch_pool.submit(get_rating_spec_changes, rating_spec, office_id, db_discs): (rating_spec, db_discs)
+                   for (office_id, rating_spec), db_discs in specs.items()}
+        stores = {}
+        for future in as_completed(fetches):
+            rating_spec, db_discs = fetches[future]
+            try:
+                data, changes = future.result()
+            except Exception as error:
+                logger.error(f'ERROR: rating specification {rating_spec} could not be read: {error}')
+                rating_errors.append([rating_spec, db_discs])
+                continue
+            if not changes:
+                unchanged += 1
+                continue
+            changed.append([rating_spec, changes])
+            if dry_run:
+                for field, (old, new) in changes.items():
+                    logger.info(f'DRY RUN: {rating_spec} {field}: {old} -> {new}')
+            else:
+                stores[store_pool.submit(store_rating_spec, data)] = (rating_spec, db_discs)
+        for future in as_completed(stores):
+            rating_spec, db_discs = stores[future]
+            try:
+                future.result()
+                stored += 1
+                logger.info(f'SUCCESS: rating specification changes stored for {rating_spec}')
+            except Exception as error:
+                logger.error(f'ERROR: rating specification {rating_spec} could not be updated: {error}')
+                rating_errors.append([rating_spec, db_discs])
+
+    logger.info(f'{unchanged} rating specifications already had the USGS values and were skipped')
+    if dry_run:
+        logger.info(f'DRY RUN: {len(changed)} rating specifications would be updated')
+    else:
+        logger.info(f'{stored} rating specifications were updated')
+    return rating_errors
+
+
+def main():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-f", "--filename", default="1", help="fileaname of ini file to be processed")
+    parser.add_argument("-a", "--api_root", required=True, type=str, help="Api Root for CDA (Required).")
+    parser.add_argument("-k", "--api_key", default=None, type=str, help="api key. one of api_key or api_key_loc are required")
+    parser.add_argument("-kl", "--api_key_loc", default=None, type=str, help="file storing Api Key. One of api_key or api_key_loc are required")
+    parser.add_argument("-b", "--bulk", action="store_true", help="Parse the whole ini file first and update each rating specification once, reading and storing the specifications in parallel")
+    parser.add_argument("-w", "--workers", default=8, type=int, help="bulk: Number of rating specifications read from and stored to CDA in parallel")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Report the changes that would be made to the rating specifications without storing them. Implies --bulk")
+    args = vars(parser.parse_args())
+
+    APIROOT = args["api_root"]
+    # place a file in .cwms names api_key that holds you apikey
+    # to be used to write data to the database using CDA
+    if args["api_key_loc"] is not None:
+        api_key_loc = args["api_key_loc"]
+        with open(api_key_loc, "r") as f:
+            APIKEY = f.readline().strip()
+    elif args["api_key"] is not None:
+        APIKEY=args["api_key"]
+    else:
+        raise Exception("must add a value to either --api_key(-a) or --api_key_loc(-al)") 
+
+    INI_FILENAME = args["filename"]
+
+    # import CWMS module and assign the apiROOT and apikey to be
+    # used throughout the program
+    apiKey = "apikey " + APIKEY
+    cwms.api.init_session(api_root=APIROOT, api_key=apiKey)
+
+    logger.info(f"CDA connection: {APIROOT}")
+    logger.info(f"Opening ini file: {INI_FILENAME}")
+    ini_file = open(INI_FILENAME, "r")
+    lines = ini_file.readlines()
+    ini_file.close()
+
+    if args["bulk"] or args["dry_run"]:
+        rating_errors = bulk_update_rating_specs(lines, args["workers"], args["dry_run"])
+    else:
+        rating_errors = []
+        for rating_spec, office_id, db_disc in iter_ini_rating_specs(lines):
+            logger.info(f'Updating rating specification: {rating_spec}')
+            try:
+                update_rating_spec(rating_spec, office_id, db_disc)
+                logger.info('SUCCESS: rating specification changes stored')
+            except:
+                logger.error('ERROR: rating specificataion could not be update')
+                rating_errors.append([rating_spec, db_disc])
     logger.info(f'ERRORS: The following rating specifications could not be updated {rating_errors}')
 
 
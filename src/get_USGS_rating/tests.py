@@ -0,0 +1,143 @@
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import getUSGS_ratings_CDA
+from rating_ini_file_import import parse_ini_line, iter_ini_rating_specs
+
+
+def parse_ini_line_charwise(line) :
+    '''
+    character by character parse_ini_line that the split based tokenizer replaced, kept as the reference of the
+    equivalence test and the baseline of benchmark_ratings.py tokenize
+    '''
+    if line.find("'") > 0 or line.find('"') > 0 :
+        #---------------------------#
+        # fields with spaces quoted #
+        #---------------------------#
+        c1 = [c for c in line]
+        escape = False
+        quote = None
+        c2 = []
+        for c in c1 :
+            if c == '\\' :
+                escape = not escape
+                if not escape : c2.append(c)
+                continue
+            if c in ('"', "'") :
+                if not quote :
+                    quote = c
+                    continue
+                if c == quote :
+                    quote = None
+                    continue
+            if c.isspace() and quote :
+                c = chr(0)
+            c2.append(c)
+        fields = "".join(c2).split()
+        for i in range(len(fields)) :
+            fields[i] = fields[i].replace(chr(0), " ")
+    elif line.find("\t") > 0 :
+        #------------------------------------------------------------#
+        # all fields without spaces separated by tabs (version < 5.0 #
+        #------------------------------------------------------------#
+        fields = line.split("\t")
+    else :
+        #-----------------------#
+        # no fields with spaces #
+        #-----------------------#
+        fields = line.split()
+    return fields
+
+
+class ParseIniLineTest(unittest.TestCase):
+
+    # characters that change how a line is split, mixed with a few plain ones
+    alphabet = ["a", "b", "1", "$", "(", ")", "#", "=", " ", " ", "\t", "\n", '"', '"', "'", "'",
+                "\\", "\\", chr(0), "\x1c", "\xa0", "\u2028"]
+
+    def random_line(self, rng):
+        line = "".join(rng.choice(self.alphabet) for _ in range(rng.randint(0, 30)))
+        # a quote is only handled when it is not the first character
+        return line if rng.random() < 0.2 else "store_exsa " + line
+
+    def test_matches_charwise_parser(self):
+        rng = random.Random(5)
+        for _ in range(20000):
+            line = self.random_line(rng)
+            self.assertEqual(parse_ini_line_charwise(line), parse_ini_line(line), repr(line))
+
+    def test_quoted_fields(self):
+        self.assertEqual(["store_exsa", "USGS 07331000", "Stage Flow", "$($db_exsa)"],
+                         parse_ini_line("""store_exsa "USGS 07331000" 'Stage Flow' $($db_exsa)"""))
+        self.assertEqual(["store_exsa", "it's a", "b"], parse_ini_line('''store_exsa "it's a" b'''))
+        self.assertEqual(["store_exsa", "not closed"], parse_ini_line('store_exsa "not closed'))
+
+    def test_backslash_escapes(self):
+        self.assertEqual(["store_corr", "C:\\ratings\\1.rdb"], parse_ini_line("store_corr 'C:\\\\ratings\\\\1.rdb'"))
+        self.assertEqual(["store_corr", "ab"], parse_ini_line("store_corr 'a\\b'"))
+
+    def test_tab_separated(self):
+        self.assertEqual(["store_base", "07331000", "", "$($db_base)"],
+                         parse_ini_line("store_base\t07331000\t\t$($db_base)"))
+
+    def test_unquoted(self):
+        self.assertEqual(["store_exsa", "07331000", "$($db_exsa)"], parse_ini_line("store_exsa  07331000 $($db_exsa)"))
+
+    def test_ini_rating_specs(self):
+        lines = ["cwms_office=SWT\n",
+                 "db_exsa=\\$localid.Stage;Flow.USGS-EXSA.Production\n",
+                 "localid=KEYS\n",
+                 'store_exsa "a b" $($db_exsa)  # comment\n',
+                 "store_exsa x y\n"]
+        self.assertEqual([["KEYS.Stage;Flow.USGS-EXSA.Production", "SWT", "USGS-EXSA"]],
+                         list(iter_ini_rating_specs(lines)))
+
+
+class RatingSpecCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dir = directory.name
+        specs = pd.DataFrame({"rating-id": ["A", "B", "C"],
+                              "effective-dates": [["2024-01-01T00:00:00Z"], np.nan, ["2023-01-01T00:00:00Z"]]})
+        pd.to_pickle({"created": datetime.now(), "mask": None, "rating_specs": specs},
+                     getUSGS_ratings_CDA.rating_spec_cache_file("SWT", self.cache_dir))
+
+    def test_saved_effective_dates_added(self):
+        saved = [["A", "07331000", "EXSA", "2024-03-01T10:00:00-06:00"],
+                 ["B", "07332000", "BASE", "2024-03-02T10:00:00-06:00"]]
+        getUSGS_ratings_CDA.update_rating_spec_cache("SWT", self.cache_dir, saved)
+        specs = getUSGS_ratings_CDA.get_rating_ids_from_specs_cached("SWT", self.cache_dir)
+        self.assertEqual([["2024-01-01T00:00:00Z", "2024-03-01T10:00:00-06:00"],
+                          ["2024-03-02T10:00:00-06:00"],
+                          ["2023-01-01T00:00:00Z"]], specs["effective-dates"].tolist())
+
+    def test_unreadable_cache_removed(self):
+        cache_file = getUSGS_ratings_CDA.rating_spec_cache_file("SWT", self.cache_dir)
+        with open(cache_file, "w") as f:
+            f.write("not a pickle")
+        getUSGS_ratings_CDA.update_rating_spec_cache("SWT", self.cache_dir, [["A", "1", "EXSA", "2024-03-01"]])
+        self.assertFalse(os.path.isfile(cache_file))
+
+
+class UsgsHttpCopyTest(unittest.TestCase):
+
+    def test_same_as_getUSGS_copy(self):
+        # the USGS http client is kept in each script directory so they can be deployed on their own
+        directory = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(directory, "usgs_http.py"), "rb") as f:
+            module = f.read()
+        with open(os.path.join(directory, "..", "getUSGS", "usgs_http.py"), "rb") as f:
+            other_module = f.read()
+        self.assertEqual(module, other_module, "usgs_http.py differs from src/getUSGS/usgs_http.py")
+
+
+if __name__ == '__main__':
+    unittest.main()
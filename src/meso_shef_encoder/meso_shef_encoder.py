@@ -35,6 +35,7 @@ import csv
 import datetime
 import decimal
 import optparse
+import numpy as np
 from dateutil import relativedelta, parser, tz
 
 #************************  Configurations  ************************************
@@ -180,19 +181,56 @@ class procVars():
 class dataTools():
     # Loads the input file containing the mesonet data into a list
     def getDataFile(self, inFile):
+        return [row for row in self.iterDataFile(inFile)]
+    
+    # Reads the input file containing the mesonet data one row at a time
+    def iterDataFile(self, inFile):
         print('Loading data from: {}'.format(inFile))
         with open(inFile, 'r') as f:
-            csvReader = csv.reader(f)
-            rawData = [row for row in csvReader]
-        return rawData
+            for row in csv.reader(f):
+                yield row
     
     # Parses the mesonet data into a dictionary
     def parser(self, rawData):
-        self.getHourly()
+        data = {}   # Format: {usace_id:{sId:'foo',{usace_param:{date:value}}}}
+        for uId, sId, st, desc, c, u, date, v in self.iterRecords(rawData):
+            # Store in dictionary
+            if uId in data:
+                if c in data[uId]:
+                    data[uId][c]['data'][date] = v
+                    if not data[uId][c]['units']:
+                        data[uId][c]['units'] = u
+                else:
+                    data[uId][c]={'units':u,
+                                 'data':{date:v}}
+            else:
+                data[uId] = {'sId':sId ,
+                            'state': st,
+                            'desc': desc,
+                            c:{'units':u,
+                               'data':{date: v}}}
+        return data
+    
+    # Column lookups of a "C" row, made once for all of the data rows after it
+    # - returns the UTC column index, a list of [index, column, is hourly, 
+    #   stored] for each column and the hourly columns
+    def colMaps(self, cols, hrly):
+        if 'UTC' not in cols:
+            raise ValueError('No UTC column found in: {}'.format(cols))
+        utcIdx = cols.index('UTC')
+        colMap = [[i, c, c in hrly, i > 1 and c != 'UTC'] 
+                  for i, c in enumerate(cols)]
+        hrlyCols = [[i, c] for i, c in enumerate(cols) if c in hrly]
+        return utcIdx, colMap, hrlyCols
     
+    # Reads the mesonet rows in a single pass - yields [usace_id, sId, state,
+    # description, usace_param, units, date, value] for each top of the hour
+    # value as soon as its row is read. The values are the strings of the file,
+    # they are converted a column at a time by convertData
+    def iterRecords(self, rawData):
         # Initialize local variables
-        data = {}   # Format: {usace_id:{sId:'foo',{usace_param:{date:value}}}}
         desc = ''
+        sId = None
         self.idXref = procVars_inst.idXref
         hrly = {}   # Dictionary for params needing hourly sums
         for mP in self.getHourly()[1]:
@@ -201,103 +239,76 @@ class dataTools():
         # Iterate each row
         for row in rawData:
             # Skip empty rows
-            if row:
-                # Get id and soil depths
-                if row[0] == 'B':
-                    uId = self.getId(row)
-                    dpths = [r for r in row]
-                     
-                    # Get sId 
-                    sId = self.getShefId(uId)
-                    
-                    # Create a SHEF id if one could not be determined add 
-                    # description to be used in SHEF message
-                    desc = ''
-                    if not sId:
-                        sId = self.genShefId(uId)
-                        desc = 'No valid lid was found for {}. Using: {}' \
-                                .format(uId, sId)
-                    
-                    # Get state
-                    st = self.getState(uId, sId)
+            if not row:
+                continue
+            # Get id and soil depths
+            if row[0] == 'B':
+                uId = self.getId(row)
+                dpths = [r for r in row]
+                 
+                # Get sId 
+                sId = self.getShefId(uId)
                 
-                # Get columns
-                if row[0] == 'C':
-                    cols = [r for r in row]
-                    
-                    # Combine depths
-                    cols = self.addDpths(dpths, cols)
-                                    
-                # Get units
-                if row[0] == 'Units':
-                    units = [r for r in row]
-                    
-                # Get data
-                if row[0].isdigit():
-                    # Continue if there is a valid sId
-                    if sId:
-                        date = row[cols.index('UTC')]
-                        date = datetime.datetime.strptime(date, '%d%b%Y %H%M')
-                        # Only keep top of the hour data
-                        if date.minute == 00:
-                            for i in range(len(cols)): 
-                                c = cols[i]
-                                sP = [sp for p,sp in paramXref.items() 
-                                      if p in c]
-                                u = units[i]
-                                v = row[i]
-                                # Replace value with hourly sum if 12 values
-                                if c in hrly:
-                                    if v:
-                                        if self.isDigit(v):
-                                            hrly[c]['sum'] += float(v)
-                                            hrly[c]['cnt'] += 1
-                                        # Only if 12 5-min values
-                                        if hrly[c]['cnt'] == 12:
-                                            v = str(hrly[c]['sum'])
-                                        else:
-                                            v = '-9999'
-                                    else:
-                                        v = '-9999'
-                                        
-                                    # Reset hourly accumulator
-                                    hrly[c]['sum'] = 0
-                                    hrly[c]['cnt'] = 0
+                # Create a SHEF id if one could not be determined add 
+                # description to be used in SHEF message
+                desc = ''
+                if not sId:
+                    sId = self.genShefId(uId)
+                    desc = 'No valid lid was found for {}. Using: {}' \
+                            .format(uId, sId)
+                
+                # Get state
+                st = self.getState(uId, sId)
+            
+            # Get columns
+            elif row[0] == 'C':
+                # Combine depths
+                cols = self.addDpths(dpths, row)
+                utcIdx, colMap, hrlyCols = self.colMaps(cols, hrly)
                                 
-                                if i > 1 and c != 'UTC' and v:
-                                    # Convert metric to English
-                                    if sP[0] in valueMods:
-                                        if 'eng' in valueMods[sP[0]]:
-                                            v, u = self.toEnglish(v, u)
-                                        elif 'metric' in valueMods[sP[0]]:
-                                            v, u = self.toMetric(v, u)
-                                    
-                                    # Store in dictionary
-                                    if len(v) > 0:
-                                        if uId in data:
-                                            if c in data[uId]:
-                                                data[uId][c]['data'][date] = v
-                                                if not data[uId][c]['units']:
-                                                    data[uId][c]['units'] = u
-                                            else:
-                                                data[uId][c]={'units':u,
-                                                             'data':{date:v}}
-                                        else:
-                                            data[uId] = {'sId':sId ,
-                                                        'state': st,
-                                                        'desc': desc,
-                                                        c:{'units':u,
-                                                           'data':{date: v}}}
-                            
-                        # Add data to hourly accumulator
-                        else:
-                            for i in range(len(cols)):
-                                c = cols[i]
-                                if c in hrly and self.isDigit(row[i]):
-                                    v = float(row[i])
-                                    hrly[c]['sum'] += v
+            # Get units
+            elif row[0] == 'Units':
+                units = [r for r in row]
+                
+            # Get data, continue if there is a valid sId
+            elif row[0].isdigit() and sId:
+                # Only keep top of the hour data, the other rows are only
+                # needed for the hourly sums
+                date = None
+                if row[utcIdx].endswith('00'):
+                    date = datetime.datetime.strptime(row[utcIdx], 
+                                                      '%d%b%Y %H%M')
+                if date and date.minute == 00:
+                    for i, c, isHrly, store in colMap:
+                        u = units[i]
+                        v = row[i]
+                        # Replace value with hourly sum if 12 values
+                        if isHrly:
+                            if v:
+                                if self.isDigit(v):
+                                    hrly[c]['sum'] += float(v)
                                     hrly[c]['cnt'] += 1
-        return data        
+                                # Only if 12 5-min values
+                                if hrly[c]['cnt'] == 12:
+                                    v = str(hrly[c]['sum'])
+                                else:
+                                    v = '-9999'
+                            else:
+                                v = '-9999'
+                                
+                            # Reset hourly accumulator
+                            hrly[c]['sum'] = 0
+                            hrly[c]['cnt'] = 0
+                        
+                        if store and v:
+                            yield [uId, sId, st, desc, c, u, date, v]
+                        
+                # Add data to hourly accumulator
+                else:
+                    for i, c in hrlyCols:
+                        if self.isDigit(row[i]):
+                            hrly[c]['sum'] += float(row[i])
+                            hrly[c]['cnt'] += 1
     
     # Get mesonet location id from row - returns the id
     def getId(self, row):
@@ -331,10 +342,8 @@ class dataTools():
                        
         # uId is not an sId, check cross reference list
         else:
-            if self.idXref:
-                sId = [n for u,n in self.idXref.items() if uId == u]
-                if sId:
-                    return sId[0].upper()
+            if self.idXref and uId in self.idXref:
+                return self.idXref[uId].upper()
             
         # Use uId as SHEF id if 8 characters or less
         if len(uId) <= 8:
@@ -351,59 +360,122 @@ class dataTools():
                   'NWSLID was not found. Using {}'.format(uId, sId))
         return sId
                 
-    # Convert units to English
-    def toEnglish(self, value, fromU):
-        try:
-            value = float(value)
-            if value != -9999:
-                # From millimiters to inches
-                if fromU == 'mm':
-                    return str((value/25.4)), 'in'
-                # From kilometers per hour to miles per hour
-                elif fromU == 'kph':
-                    return str((value/1.609)), 'mph'
-                # From Fahrenheit to Celcius
-                elif fromU == 'C':
-                    return str((value * (9/5)) + 32),'F'
+    # Converts the values of every parameter a column at a time. Adds the 
+    # sorted dates, the values as floats and the missing value flags of each 
+    # parameter and sets its units to the converted units
+    def convertData(self, data):
+        for uId in data:
+            for c in data[uId]:
+                if c in ['sId', 'state', 'desc']:
+                    continue
+                param = data[uId][c]
+                dates = sorted(param['data'].keys())
+                values = [param['data'][dT] for dT in dates]
+                shef_p = [sp for p,sp in paramXref.items() if p in c]
+                mods = valueMods.get(shef_p[0], []) if shef_p else []
+                if 'eng' in mods:
+                    values, missing, units = self.toEnglish(values, 
+                                                            param['units'])
+                elif 'metric' in mods:
+                    values, missing, units = self.toMetric(values, 
+                                                           param['units'])
                 else:
-                    print('WARNING: {} input unit is not supported for conversion'\
-                           ' to English units'.format(fromU))
-            else:
-                return '-9999', ''
-            
-        except ValueError:
-            print("WARNING: {} is not a valid number".format(value))
-            return '-9999',''
-        
-        return str(value), fromU
-        
-    # Unit converter
-    def toMetric(self, value, fromU):
+                    dates, values, missing = self.toValues(dates, values)
+                    units = param['units']
+                param['dates'] = dates
+                param['values'] = values
+                param['missing'] = missing
+                param['units'] = units
+        return data
+    
+    # Converts value strings to floats - returns the values and a list of the 
+    # values that are not numbers. The values that are not numbers are -9999
+    def toFloats(self, values):
         try:
-            value = float(value)
-            if value != -9999:
-                # From in to mm
-                if fromU == 'in':
-                    return str(value * 25.4), 'mm'
-                # From in to m
-                elif fromU == 'in':
-                    return str(value * 0.0254), 'm'
-                # From F to C
-                elif fromU == 'F':
-                    return str(((value - 32) * 5)/9), 'C'
-                # From langley/min to W/m^2
-                elif fromU == 'langley/min':
-                    return str(value * 697.3), 'W/m^2'
-                else:
-                    print('WARNING: {} input unit is not supported for '\
-                          'conversion to metric units'.format(fromU))
-            else:
-                return '-9999',''
+            return np.array(values, dtype=float), []
         except ValueError:
-            print("WARNING: {} is not a valid number".format(value))
-            return '-9999',''
+            floats = np.empty(len(values))
+            invalid = []
+            for i, v in enumerate(values):
+                try:
+                    floats[i] = float(v)
+                except ValueError:
+                    floats[i] = -9999
+                    invalid.append(i)
+            return floats, invalid
+    
+    # Values of a parameter without a unit conversion - the missing value 
+    # indicator is flagged, other values that are not numbers are dropped
+    def toValues(self, dates, values):
+        floats, invalid = self.toFloats(values)
+        missing = np.zeros(len(values), dtype=bool)
+        if invalid:
+            keep = np.ones(len(values), dtype=bool)
+            for i in invalid:
+                if values[i] == missVal:
+                    missing[i] = True
+                else:
+                    print("WARNING: {} is not a valid number".format(values[i]))
+                    keep[i] = False
+            dates = [dT for dT, k in zip(dates, keep) if k]
+            floats = floats[keep]
+            missing = missing[keep]
+        return dates, floats, missing
+    
+    # Converts a column of values to English units. Values that are not 
+    # numbers are -9999 - returns the values, missing value flags and units
+    def toEnglish(self, values, fromU):
+        value, invalid = self.toFloats(values)
+        for i in invalid:
+            print("WARNING: {} is not a valid number".format(values[i]))
+        valid = value != -9999
+        # From millimiters to inches
+        if fromU == 'mm':
+            value[valid] = value[valid]/25.4
+            toU = 'in'
+        # From kilometers per hour to miles per hour
+        elif fromU == 'kph':
+            value[valid] = value[valid]/1.609
+            toU = 'mph'
+        # From Fahrenheit to Celcius
+        elif fromU == 'C':
+            value[valid] = (value[valid] * (9/5)) + 32
+            toU = 'F'
+        else:
+            print('WARNING: {} input unit is not supported for conversion'\
+                   ' to English units'.format(fromU))
+            toU = fromU
+        # Missing values do not have units
+        if not valid.any():
+            toU = ''
+        return value, np.zeros(len(value), dtype=bool), toU
         
-        return str(value), fromU
+    # Unit converter
+    def toMetric(self, values, fromU):
+        value, invalid = self.toFloats(values)
+        for i in invalid:
+            print("WARNING: {} is not a valid number".format(values[i]))
+        valid = value != -9999
+        # From in to mm
+        if fromU == 'in':
+            value[valid] = value[valid] * 25.4
+            toU = 'mm'
+        # From F to C
+        elif fromU == 'F':
+            value[valid] = ((value[valid] - 32) * 5)/9
+            toU = 'C'
+        # From langley/min to W/m^2
+        elif fromU == 'langley/min':
+            value[valid] = value[valid] * 697.3
+            toU = 'W/m^2'
+        else:
+            print('WARNING: {} input unit is not supported for '\
+                  'conversion to metric units'.format(fromU))
+            toU = fromU
+        # Missing values do not have units
+        if not valid.any():
+            toU = ''
+        return value, np.zeros(len(value), dtype=bool), toU
         
     # Output data to file
     def toFile(self, outFile, data):
@@ -496,6 +568,7 @@ class shefEncoder():
         body = ''
         numLocs = 0
         sites = [s for s,v in data.items() if v['state'] == st]
+        hrlyShef = dataTools_inst.getHourly()[0]
         
         # Code to populate body
         for s in sites:
@@ -529,7 +602,7 @@ class shefEncoder():
                             body += ': {}\n'.format(pDesc)
                             
                             # Create shef code
-                            if shef_p in dataTools_inst.getHourly()[0]:
+                            if shef_p in hrlyShef:
                                 pedstep = '{}HRZ'.format(shef_p)
                             else:
                                 pedstep = '{}IRZ'.format(shef_p)
@@ -547,24 +620,21 @@ class shefEncoder():
                             
                             # Populate values
                             lLen = 1   
-                            for dT in sorted(data[s][p]['data'].keys()):     
-                                v = data[s][p]['data'][dT]
-                                if len(v) > 0:  # Skip empty values
+                            # Modify values if needed
+                            for v in self.formatValues(data[s][p], shef_p, p):
+                                # Start new line
+                                if lLen == 1:          
+                                    body += '.E1 {}'.format(v)
+                                    lLen += 4 + len(v)
+                                else:
+                                    lLen += 2 + len(v)
+                                    # Continue on same line til max len
+                                    if lLen > 1 and lLen < lineLenMax:
+                                        body += '/ {}'.format(v)
                                     # Start new line
-                                    # Modify value if needed
-                                    v = self.valueMod(v, shef_p, p)
-                                    if lLen == 1:          
-                                        body += '.E1 {}'.format(v)
-                                        lLen += 4 + len(v)
                                     else:
-                                        lLen += 2 + len(v)
-                                        # Continue on same line til max len
-                                        if lLen > 1 and lLen < lineLenMax:
-                                            body += '/ {}'.format(v)
-                                        # Start new line
-                                        else:
-                                            body += '\n.E1 {}'.format(v)
-                                            lLen = 4 + len(v)
+                                        body += '\n.E1 {}'.format(v)
+                                        lLen = 4 + len(v)
                         body += '\n\n'
         bodies.append(body)
         return bodies
@@ -586,40 +656,53 @@ class shefEncoder():
             if k in param:
                 return v
         
-    # Adjust value or convert to vector value if necessary
-    def valueMod(self, value, shef_p, usace_p):
-        # 1. Assign and return missing value if missing
-        if value == missVal:
-            return '-9999'
+    # Format the values of a parameter converted by dataTools.convertData, 
+    # adjusting them or converting them to vector values if necessary
+    # - returns the SHEF value strings in date order
+    def formatValues(self, param, shef_p, usace_p):
+        value = param['values']
         
-        # 2. Check if value is a valid number
-        try: 
-            value = float(value)
-        except ValueError:
-            print("WARNING: {} is not a valid number".format(value))
-            return
-        
-        # 3. Apply and return custom modifications
-        if shef_p in valueMods:
-            for mod in valueMods[shef_p]:
-                # Make vector
-                if 'vector' in mod:
-                    vector = ''
-                    depth = self.getDepth(usace_p)
-                    
-                    # Get value
-                    value = float(value) / 1000
-                    vector = '{:.4f}'.format(abs(value)).replace('0.','.')
-                    vector = '{}{}'.format(depth, vector)
-                    if value < 0:
-                        vector = '-' + vector
-                    return vector
-                # Round value
-                elif 'R' in mod:
-                    return self.valRounder(value, mod)
+        # 1. Apply custom modifications
+        vals = None
+        for mod in valueMods.get(shef_p, []):
+            # Make vector
+            if 'vector' in mod:
+                depth = self.getDepth(usace_p)
+                value = value / 1000
+                vals = ['{}{}'.format(depth, '{:.4f}'.format(v).replace('0.','.'))
+                        for v in np.abs(value).tolist()]
+                vals = ['-' + v if neg else v 
+                        for v, neg in zip(vals, (value < 0).tolist())]
+                break
+            # Round value
+            elif 'R' in mod:
+                vals = self.roundValues(value, mod)
+                break
                             
-        # 4. Apply and return default mod (round to 2 decimals)
-        return '{:>7.2f}'.format(value)
+        # 2. Apply default mod (round to 2 decimals)
+        if vals is None:
+            vals = ['{:>7.2f}'.format(v) for v in value.tolist()]
+        
+        # 3. Assign missing value if missing
+        if param['missing'].any():
+            vals = ['-9999' if m else v 
+                    for v, m in zip(vals, param['missing'].tolist())]
+        return vals
+    
+    # Round a column of values with ROUND_HALF_UP - returns the value strings
+    def roundValues(self, value, modCode):
+        p_val = int(modCode.replace('R', ''))
+        absVal = np.abs(value)
+        # Whole numbers are rounded here, other values by valRounder
+        fast = np.isfinite(value) & (absVal < 2**52) if p_val == 0 else \
+               np.zeros(len(value), dtype=bool)
+        whole = np.floor(absVal)
+        whole = np.where(absVal - whole >= 0.5, whole + 1, whole)
+        whole = np.where(fast, whole, 0).astype(np.int64)
+        neg = np.signbit(value)
+        return [('-' if n else '') + str(w) if f else self.valRounder(v, modCode)
+                for v, w, n, f in zip(value.tolist(), whole.tolist(), 
+                                      neg.tolist(), fast.tolist())]
         
     # Get depth from usace parameter
     def getDepth(self, usace_p):
@@ -649,11 +732,10 @@ class shefEncoder():
 
     # Value rounder
     def valRounder(self, value, modCode):
-        ctx = decimal.getcontext()
-        ctx.rounding = decimal.ROUND_HALF_UP
         value = decimal.Decimal(value)
         p_val = int(modCode.replace('R', ''))
-        return str(round(value, p_val))
+        exp = decimal.Decimal((0, (1,), -p_val))
+        return str(value.quantize(exp, rounding=decimal.ROUND_HALF_UP))
        
    
 #------------------------------------------------------------------------------ 
@@ -664,13 +746,16 @@ if __name__ == '__main__':
     dataTools_inst = dataTools()
     shefEncoder_inst = shefEncoder()
     
-    # Get raw data from input file
+    # Read the input file a row at a time
     inFile = procVars_inst.inFile
-    rawData = dataTools_inst.getDataFile(inFile)
+    rawData = dataTools_inst.iterDataFile(inFile)
     
     # Parse data into dictionary
     data = dataTools_inst.parser(rawData)
     
+    # Convert the units of each parameter
+    data = dataTools_inst.convertData(data)
+    
     ### SHEF encode the data
     # Split into states and limit gages to maxLocs value 
     # due to possible size limitations
@@ -0,0 +1,53 @@
+import io
+import os
+import datetime
+import unittest
+from contextlib import redirect_stdout
+
+import numpy as np
+from dateutil import tz
+
+import meso_shef_encoder
+
+
+class ProcVarsStub():
+    # procVars without the command line arguments
+    idXref = ''
+    curTime = datetime.datetime(2024, 4, 19, 17, 0, tzinfo=tz.tzutc())
+
+
+class GoldenFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sDir = os.path.dirname(os.path.realpath(__file__))
+        meso_shef_encoder.procVars_inst = ProcVarsStub()
+        meso_shef_encoder.dataTools_inst = meso_shef_encoder.dataTools()
+
+    def encode(self, inFile):
+        dataTools_inst = meso_shef_encoder.dataTools_inst
+        shefEncoder_inst = meso_shef_encoder.shefEncoder()
+        with redirect_stdout(io.StringIO()):
+            data = dataTools_inst.parser(dataTools_inst.iterDataFile(inFile))
+            data = dataTools_inst.convertData(data)
+            messages = []
+            for st in sorted(set(v['state'] for v in data.values())):
+                messages.extend(shefEncoder_inst.makeShef(data, st))
+        return "\n".join(messages)
+
+    def test_mesonet_data(self):
+        # MesonetData.shef is the output of the encoder before the values were converted a column at a time
+        shef = self.encode(os.path.join(self.sDir, "MesonetData.csv"))
+        with open(os.path.join(self.sDir, "MesonetData.shef"), "r") as f:
+            golden = f.read()
+        self.assertEqual(golden, shef)
+
+    def test_round_half_up(self):
+        shefEncoder_inst = meso_shef_encoder.shefEncoder()
+        values = np.array([0.5, 1.5, 2.5, -2.5, -0.3, 359.49, 359.5])
+        self.assertEqual(["1", "2", "3", "-3", "-0", "359", "360"], shefEncoder_inst.roundValues(values, "R0"))
+        self.assertEqual([shefEncoder_inst.valRounder(v, "R1") for v in values],
+                         shefEncoder_inst.roundValues(values, "R1"))
+
+
+if __name__ == '__main__':
+    unittest.main()